@@ -0,0 +1,37 @@
+"""Attention backend benchmarks; run from the repository root with `python -m benchmarks.bench_attention`"""
+import argparse
+
+import torch
+
+import clip
+from benchmarks.common import MODEL_CONFIGS, benchmark, synthetic_model
+from clip.clip import _MODELS
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--models", nargs="+", choices=list(MODEL_CONFIGS), default=list(_MODELS))
+    parser.add_argument("--image-batch-size", type=int, default=4)
+    parser.add_argument("--text-batch-size", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    text = clip.tokenize(["a photo of a {}.".format(i) for i in range(args.text_batch_size)])
+    print(f"CPU latency ({torch.get_num_threads()} threads) of encode_image on {args.image_batch_size} images and "
+          f"encode_text on {len(text)} padded prompts, per attention backend")
+    print(f"  {'model':>9} {'image mha (ms)':>15} {'image sdpa (ms)':>16} {'text mha (ms)':>14} {'text sdpa (ms)':>15}")
+    for name in args.models:
+        model = synthetic_model(name)
+        resolution = model.visual.input_resolution
+        images = torch.randn(args.image_batch_size, 3, resolution, resolution)
+        timings = []
+        for backend in ["mha", "sdpa"]:
+            model.set_attention_backend(backend)
+            timings.append((benchmark(model.encode_image, images, repeat=args.repeat),
+                            benchmark(model.encode_text, text, repeat=args.repeat)))
+        (image_mha, text_mha), (image_sdpa, text_sdpa) = timings
+        print(f"  {name:>9} {image_mha * 1000:15.1f} {image_sdpa * 1000:16.1f} {text_mha * 1000:14.1f} {text_sdpa * 1000:15.1f}")
+
+
+if __name__ == "__main__":
+    main()
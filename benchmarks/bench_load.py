@@ -0,0 +1,84 @@
+"""
+Cold-start benchmarks of build_model and clip.load; run from the repository root with `python -m benchmarks.bench_load`.
+The synthetic checkpoints are state dicts; the released checkpoints are JIT archives, whose parsing adds to the time
+of a load without the converted checkpoint cache.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+from benchmarks.common import MODEL_CONFIGS, synthetic_state_dict
+
+
+def child(checkpoint: str, precision: str, mode: str, download_root: str = None, towers: str = "both"):
+    """
+    Loads the model in a fresh process, printing the elapsed time and the peak RSS as JSON. The modes are "legacy",
+    which initializes random weights, converts them, then copies the checkpoint over them, "meta", which builds
+    the model on the meta device, and "load", which calls clip.load with its converted checkpoint cache and `towers`.
+    """
+    import clip
+    import clip.model
+    if mode == "legacy":
+        clip.model._supports_assign = lambda: False
+
+    start = time.perf_counter()
+    if mode == "load":
+        model = clip.load(checkpoint, device="cpu", precision=precision, download_root=download_root, towers=towers,
+                          cache=True)[0]
+    else:
+        state_dict = torch.load(checkpoint, map_location="cpu")
+        model = clip.model.build_model(state_dict, precision=precision)
+    elapsed = time.perf_counter() - start
+    for tensor in model.state_dict().values():  # pages memory-mapped weights in, as the first forward pass would
+        tensor.sum()
+    # ru_maxrss survives exec, so it would report the parent's peak; VmHWM belongs to this process's address space
+    with open("/proc/self/status") as f:
+        peak_rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+    print(json.dumps({"seconds": elapsed, "peak_rss": peak_rss}))
+
+
+def measure(checkpoint: str, precision: str, mode: str, download_root: str = None, towers: str = "both") -> dict:
+    command = [sys.executable, "-m", "benchmarks.bench_load", "--child", checkpoint, "--precisions", precision, "--mode", mode,
+               "--towers", towers]
+    if download_root:
+        command += ["--download-root", download_root]
+    return json.loads(subprocess.run(command, check=True, capture_output=True, text=True).stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--models", nargs="+", choices=list(MODEL_CONFIGS), default=["RN50", "ViT-B/32", "ViT-B/16", "RN50x16"])
+    parser.add_argument("--precisions", nargs="+", choices=["fp32", "fp16", "bf16"], default=["fp32", "fp16"])
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    parser.add_argument("--download-root", help=argparse.SUPPRESS)
+    parser.add_argument("--towers", default="both", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child, args.precisions[0], args.mode, args.download_root, args.towers)
+
+    print("torch.load + build_model of an fp16 checkpoint in a fresh process, initializing then loading vs constructing "
+          "on the meta device, and clip.load without (cold) and with (warm) its converted checkpoint")
+    print(f"  {'model':>9} {'precision':>9} {'checkpoint (MB)':>16} {'init+load (s)':>14} {'meta (s)':>9} {'cold (s)':>9} "
+          f"{'warm (s)':>9} {'init+load RSS (MB)':>19} {'meta RSS (MB)':>14} {'warm RSS (MB)':>14}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.models:
+            checkpoint = os.path.join(directory, "checkpoint.pt")
+            torch.save({k: v.half() if v.is_floating_point() else v for k, v in synthetic_state_dict(name).items()}, checkpoint)
+            for precision in args.precisions:
+                download_root = tempfile.mkdtemp(dir=directory)
+                legacy, meta = measure(checkpoint, precision, "legacy"), measure(checkpoint, precision, "meta")
+                cold, warm = [measure(checkpoint, precision, "load", download_root) for _ in range(2)]
+                print(f"  {name:>9} {precision:>9} {os.path.getsize(checkpoint) / 2 ** 20:16.1f} {legacy['seconds']:14.2f} "
+                      f"{meta['seconds']:9.2f} {cold['seconds']:9.2f} {warm['seconds']:9.2f} {legacy['peak_rss'] / 2 ** 20:19.0f} "
+                      f"{meta['peak_rss'] / 2 ** 20:14.0f} {warm['peak_rss'] / 2 ** 20:14.0f}")
+
+if __name__ == "__main__":
+    main()
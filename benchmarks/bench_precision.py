@@ -0,0 +1,49 @@
+"""Precision policy benchmarks; run from the repository root with `python -m benchmarks.bench_precision`"""
+import argparse
+
+import torch
+
+import clip
+from benchmarks.common import MODEL_CONFIGS, benchmark, synthetic_model
+from clip.model import PRECISIONS
+
+
+def parameter_bytes(model: torch.nn.Module) -> int:
+    return sum(t.numel() * t.element_size() for t in [*model.parameters(), *model.buffers()])
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--models", nargs="+", choices=list(MODEL_CONFIGS), default=["RN50", "ViT-B/32", "ViT-B/16"])
+    parser.add_argument("--precisions", nargs="+", choices=list(PRECISIONS), default=list(PRECISIONS),
+                        help="compared with fp32, which always runs")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--image-batch-size", type=int, default=4)
+    parser.add_argument("--text-batch-size", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    text = clip.tokenize([f"a photo of a number {i}." for i in range(args.text_batch_size)], trim=True).to(args.device)
+    print(f"build_model precisions on {args.device} ({torch.get_num_threads()} threads): parameter memory, throughput of "
+          f"encode_image on {args.image_batch_size} images and encode_text on {len(text)} prompts, and the lowest "
+          f"cosine similarity to fp32")
+    precisions = ["fp32", *[precision for precision in args.precisions if precision != "fp32"]]  # fp32 is the reference
+    print(f"  {'model':>9} {'precision':>9} {'memory (MB)':>12} {'images/s':>9} {'texts/s':>8} {'image cos':>10} {'text cos':>9}")
+    for name in args.models:
+        resolution = MODEL_CONFIGS[name]["image_resolution"]
+        images = torch.randn(args.image_batch_size, 3, resolution, resolution, device=args.device)
+        reference = None
+        for precision in precisions:
+            model = synthetic_model(name, args.device, precision=precision)
+            image_time = benchmark(model.encode_image, images, repeat=args.repeat)
+            text_time = benchmark(model.encode_text, text, repeat=args.repeat)
+            with torch.no_grad():
+                features = model.encode_image(images).float(), model.encode_text(text).float()
+            reference = reference or features
+            image_cosine, text_cosine = [torch.cosine_similarity(f, r).min() for f, r in zip(features, reference)]
+            print(f"  {name:>9} {precision:>9} {parameter_bytes(model) / 2 ** 20:12.1f} {len(images) / image_time:9.1f} "
+                  f"{len(text) / text_time:8.1f} {image_cosine:10.4f} {text_cosine:9.4f}")
+
+
+if __name__ == "__main__":
+    main()
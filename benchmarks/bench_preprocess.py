@@ -0,0 +1,56 @@
+"""Image preprocessing benchmarks; run from the repository root with `python -m benchmarks.bench_preprocess`"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from clip import BatchTransform
+from clip.clip import _transform
+
+
+def best_time(fn, repeat: int) -> float:
+    fn()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--n-px", type=int, default=224)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--sizes", nargs="+", default=["480x640", "720x1280", "1080x1920"], help="source image sizes, HxW")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    transform, batch_transform = _transform(args.n_px), BatchTransform(args.n_px, device=args.device)
+    rng = np.random.default_rng(0)
+    print(f"Preprocessing of {args.batch_size} images into {args.n_px}px inputs on {args.device} "
+          f"({torch.get_num_threads()} threads): per-image PIL transform + stack, BatchTransform of the PIL images, "
+          f"and BatchTransform of a uint8 tensor batch, with the largest difference from the PIL transform")
+    print(f"  {'size':>10} {'PIL (img/s)':>12} {'batched PIL (img/s)':>20} {'batched uint8 (img/s)':>22} {'uint8 vs PIL':>13} {'max diff':>9}")
+    for size in args.sizes:
+        height, width = map(int, size.split("x"))
+        # smooth random images, closer to photographs than noise
+        small = rng.integers(0, 256, (args.batch_size, height // 16, width // 16, 3), dtype=np.uint8)
+        images = [Image.fromarray(image).resize((width, height), Image.BILINEAR) for image in small]
+        batch = torch.from_numpy(np.stack([np.array(image) for image in images])).permute(0, 3, 1, 2).contiguous()
+
+        expected = torch.stack([transform(image) for image in images])
+        difference = (batch_transform(batch).cpu() - expected).abs().max()
+
+        pil_time = best_time(lambda: torch.stack([transform(image) for image in images]).to(args.device), args.repeat)
+        list_time = best_time(lambda: batch_transform(images), args.repeat)
+        tensor_time = best_time(lambda: batch_transform(batch), args.repeat)
+        print(f"  {size:>10} {len(images) / pil_time:12.1f} {len(images) / list_time:20.1f} {len(images) / tensor_time:22.1f} "
+              f"{pil_time / tensor_time:12.1f}x {difference:9.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Dynamic int8 quantization benchmarks and calibration check; run from the repository root with
+`python -m benchmarks.bench_quantization`. With --pretrained, the cosine similarities of the int8 embeddings
+of CLIP.png and a fixed set of captions to the fp32 ones are the accuracy check to run before deploying.
+"""
+import argparse
+import copy
+import io
+
+import torch
+from PIL import Image
+
+import clip
+from benchmarks.common import MODEL_CONFIGS, benchmark, synthetic_model
+from clip.clip import _transform
+from clip.model import quantize_int8
+
+CAPTIONS = [
+    "a diagram", "a dog", "a cat", "a photo of a dog sleeping on a couch.", "a plate of food on a wooden table.",
+    "a city street at night with cars and people.", "an aerial photo of a coastline.", "a handwritten note.",
+]
+
+
+def state_size(model: torch.nn.Module) -> int:
+    """Serialized size in bytes of the state dict, which counts packed quantized weights correctly"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--models", nargs="+", choices=list(MODEL_CONFIGS), default=["RN50", "ViT-B/32", "ViT-B/16"])
+    parser.add_argument("--pretrained", action="store_true", help="download the real checkpoints instead of using random weights")
+    parser.add_argument("--image-batch-size", type=int, default=4)
+    parser.add_argument("--text-batch-size", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    text = clip.tokenize([CAPTIONS[i % len(CAPTIONS)] for i in range(args.text_batch_size)], trim=True)
+    print(f"fp32 vs dynamic int8 on CPU ({torch.get_num_threads()} threads): state size, encode_image latency on "
+          f"{args.image_batch_size} images, encode_text latency on {len(text)} captions, and the lowest cosine "
+          f"similarity to fp32 over CLIP.png and {len(CAPTIONS)} captions")
+    print(f"  {'model':>9} {'size (MB)':>16} {'image (ms)':>16} {'text (ms)':>16} {'image cos':>10} {'text cos':>9}")
+    for name in args.models:
+        model = clip.load(name, device="cpu")[0] if args.pretrained else synthetic_model(name)
+        quantized = quantize_int8(copy.deepcopy(model))
+        resolution = model.visual.input_resolution
+        images = torch.randn(args.image_batch_size, 3, resolution, resolution)
+
+        sizes, image_times, text_times = [], [], []
+        for m in [model, quantized]:
+            sizes.append(state_size(m) / 2 ** 20)
+            image_times.append(benchmark(m.encode_image, images, repeat=args.repeat) * 1000)
+            text_times.append(benchmark(m.encode_text, text, repeat=args.repeat) * 1000)
+
+        image = _transform(resolution)(Image.open("CLIP.png"))[None]
+        captions = clip.tokenize(CAPTIONS, trim=True)
+        with torch.no_grad():
+            image_cosine = torch.cosine_similarity(model.encode_image(image), quantized.encode_image(image)).min()
+            text_cosine = torch.cosine_similarity(model.encode_text(captions), quantized.encode_text(captions)).min()
+
+        print(f"  {name:>9} {sizes[0]:7.1f} / {sizes[1]:6.1f} {image_times[0]:7.1f} / {image_times[1]:6.1f} "
+              f"{text_times[0]:7.1f} / {text_times[1]:6.1f} {image_cosine:10.4f} {text_cosine:9.4f}")
+
+
+if __name__ == "__main__":
+    main()
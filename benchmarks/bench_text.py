@@ -0,0 +1,63 @@
+"""Text tower benchmarks; run from the repository root with `python -m benchmarks.bench_text`"""
+import argparse
+from functools import lru_cache
+
+import clip
+from benchmarks.common import MODEL_CONFIGS, benchmark, synthetic_model
+from benchmarks.reference import reference_encode_text
+
+PROMPTS = ["a photo of a {}.", "a bad photo of the {}.", "a sculpture of a {}.", "itap of my {}."]
+CLASSES = ["dog", "cat", "golden retriever", "airplane", "sports car", "hot air balloon", "jellyfish", "espresso"]
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--models", nargs="+", choices=list(MODEL_CONFIGS), default=["RN50", "RN50x4", "RN50x16", "ViT-L/14"])
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model_by_name = lru_cache()(synthetic_model)
+    texts = [template.format(c) for template in PROMPTS for c in CLASSES]
+    texts = (texts * (args.batch_size // len(texts) + 1))[:args.batch_size]
+    padded = clip.tokenize(texts)
+    trimmed = clip.tokenize(texts, trim=True)
+
+    print(f"encode_text, batch of {len(texts)} prompts, padded to {padded.shape[1]} vs trimmed to {trimmed.shape[1]} tokens")
+    print(f"  {'model':>9} {'padded (ms)':>12} {'trimmed (ms)':>13} {'speedup':>8}")
+    for name in args.models:
+        model = model_by_name(name)
+        padded_time = benchmark(model.encode_text, padded, repeat=args.repeat)
+        trimmed_time = benchmark(model.encode_text, trimmed, repeat=args.repeat)
+        print(f"  {name:>9} {padded_time * 1000:12.1f} {trimmed_time * 1000:13.1f} {padded_time / trimmed_time:8.2f}")
+
+    template = "a blurry, low resolution photo taken with an old camera of the small {}."
+    shared = clip.tokenize([template.format(c) for c in (CLASSES * (args.batch_size // len(CLASSES) + 1))[:args.batch_size]], trim=True)
+    print(f"encode_text of one template over {len(shared)} classes ({shared.shape[1]} tokens), with and without share_prefix")
+    print(f"  {'model':>9} {'full (ms)':>10} {'shared (ms)':>12} {'speedup':>8}")
+    for name in args.models:
+        model = model_by_name(name)
+        full_time = benchmark(model.encode_text, shared, repeat=args.repeat)
+        shared_time = benchmark(lambda text: model.encode_text(text, share_prefix=True), shared, repeat=args.repeat)
+        print(f"  {name:>9} {full_time * 1000:10.1f} {shared_time * 1000:12.1f} {full_time / shared_time:8.2f}")
+
+    print(f"encode_text of {len(padded)} prompts ({padded.shape[1]} tokens) vs computing every row of the last layer")
+    print(f"  {'model':>9} {'width':>6} {'all rows (ms)':>14} {'eot row (ms)':>13} {'speedup':>8}")
+    for name in args.models:
+        model = model_by_name(name)
+        full_time = benchmark(reference_encode_text, model, padded, repeat=args.repeat)
+        eot_time = benchmark(model.encode_text, padded, repeat=args.repeat)
+        print(f"  {name:>9} {model.transformer.width:6d} {full_time * 1000:14.1f} {eot_time * 1000:13.1f} {full_time / eot_time:8.2f}")
+
+    print(f"repeated batches of {len(texts)} prompts through TextFeatureCache (first call is all misses)")
+    print(f"  {'model':>9} {'uncached (ms)':>14} {'cached (ms)':>12} {'hit rate':>9}")
+    for name in args.models:
+        model = model_by_name(name)
+        cache = clip.TextFeatureCache(model)
+        uncached_time = benchmark(model.encode_text, trimmed, warmup=0, repeat=1)
+        cached_time = benchmark(cache, trimmed, repeat=args.repeat)
+        print(f"  {name:>9} {uncached_time * 1000:14.1f} {cached_time * 1000:12.1f} {cache.hit_rate():9.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Token merging benchmarks; run from the repository root with `python -m benchmarks.bench_token_merging`"""
+import argparse
+import os
+
+import torch
+from PIL import Image
+
+import clip
+from benchmarks.bench_text import CLASSES, PROMPTS
+from benchmarks.common import benchmark, synthetic_model
+
+
+def load_images(image_dir: str, preprocess, resolution: int, count: int) -> torch.Tensor:
+    if image_dir is None:
+        return torch.randn(count, 3, resolution, resolution)
+    paths = sorted(os.path.join(image_dir, name) for name in os.listdir(image_dir))[:count]
+    return torch.stack([preprocess(Image.open(path)) for path in paths])
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model", choices=[name for name in clip.available_models() if name.startswith("ViT")], default="ViT-B/16")
+    parser.add_argument("--pretrained", action="store_true", help="download the real checkpoint instead of using random weights")
+    parser.add_argument("--image-dir", help="images to classify; random tensors by default, only meaningful with --pretrained")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--ratios", nargs="+", type=float, default=[0.0, 0.05, 0.1, 0.2, 0.3, 0.4])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.pretrained:
+        model, preprocess = clip.load(args.model, device="cpu")
+    else:
+        model, preprocess = synthetic_model(args.model), None
+    images = load_images(args.image_dir, preprocess, model.visual.input_resolution, args.batch_size)
+    weights = clip.build_zeroshot_head(model, CLASSES, PROMPTS)
+
+    baseline_features = baseline_top1 = None
+    print(f"{args.model} encode_image on {len(images)} images ({torch.get_num_threads()} threads), "
+          f"zero-shot over {len(CLASSES)} classes compared with no merging")
+    print(f"  {'ratio':>6} {'latency (ms)':>13} {'images/s':>9} {'cosine':>7} {'top-1 agreement':>16}")
+    for ratio in args.ratios:
+        model.visual.token_merging = ratio
+        elapsed = benchmark(model.encode_image, images, repeat=args.repeat)
+        with torch.no_grad():
+            features = model.encode_image(images).float()
+        top1 = clip.classify(model, images, weights, topk=1)[1][:, 0]
+        if baseline_features is None:
+            baseline_features, baseline_top1 = features, top1
+        cosine = torch.nn.functional.cosine_similarity(features, baseline_features).mean()
+        agreement = (top1 == baseline_top1).float().mean()
+        print(f"  {ratio:6.2f} {elapsed * 1000:13.1f} {len(images) / elapsed:9.1f} {cosine:7.4f} {agreement:16.1%}")
+
+
+if __name__ == "__main__":
+    main()
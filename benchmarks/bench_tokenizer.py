@@ -0,0 +1,159 @@
+"""Tokenizer micro-benchmarks; run from the repository root with `python -m benchmarks.bench_tokenizer`"""
+import argparse
+import random
+import string
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import clip
+from benchmarks.reference import reference_bpe
+from clip.simple_tokenizer import SimpleTokenizer, compile_bpe, default_bpe
+
+
+def synthetic_captions(n: int, seed: int = 0):
+    """Caption-like strings with the long URLs, hashtags and compound tokens that make BPE expensive"""
+    rng = random.Random(seed)
+
+    def word(lo, hi):
+        return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(lo, hi)))
+
+    captions = []
+    for _ in range(n):
+        parts = [word(2, 8) for _ in range(rng.randint(4, 12))]
+        parts.append("#" + word(10, 30))
+        parts.append(f"https://www.{word(5, 12)}.com/{word(8, 20)}/{word(8, 20)}?id={rng.randint(0, 10 ** 9)}")
+        rng.shuffle(parts)
+        captions.append(" ".join(parts))
+    return captions
+
+
+def time_bpe(bpe, tokens, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for token in tokens:
+            bpe(token)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def time_encode(tokenizer, captions, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        tokenizer.clear_cache()
+        start = time.perf_counter()
+        for caption in captions:
+            tokenizer.encode(caption)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def zipf_stream(captions, n: int, seed: int = 0):
+    """Draw captions with a Zipfian popularity so cache hit rates resemble a live caption stream"""
+    rng = random.Random(seed)
+    weights = [1.0 / (rank + 1) for rank in range(len(captions))]
+    return rng.choices(captions, weights=weights, k=n)
+
+
+def cache_sweep(captions, cache_sizes, warm_cache):
+    print(f"encode over a Zipfian stream of {len(captions)} captions, warm_cache={warm_cache}")
+    print(f"  {'cache_size':>10} {'time (ms)':>10} {'hit rate':>9} {'evictions':>10} {'entries':>8}")
+    for cache_size in cache_sizes:
+        tokenizer = SimpleTokenizer(cache_size=cache_size, warm_cache=warm_cache)
+        start = time.perf_counter()
+        for caption in captions:
+            tokenizer.encode(caption)
+        elapsed = time.perf_counter() - start
+        info = tokenizer.cache_info()
+        hit_rate = info.hits / max(info.hits + info.misses, 1)
+        print(f"  {str(cache_size):>10} {elapsed * 1000:10.1f} {hit_rate:9.1%} {info.evictions:10d} {info.currsize:8d}")
+
+
+def worker_sweep(captions, worker_counts, chunk_size):
+    print(f"tokenize_batch over {len(captions)} captions, chunk_size={chunk_size}")
+    print(f"  {'workers':>7} {'captions/s':>11} {'speedup':>8}")
+    start = time.perf_counter()
+    clip.tokenize(captions, truncate=True)
+    serial = time.perf_counter() - start
+    print(f"  {'tokenize':>7} {len(captions) / serial:11.0f} {1.0:8.2f}")
+    for num_workers in worker_counts:
+        start = time.perf_counter()
+        clip.tokenize_batch(captions, truncate=True, chunk_size=chunk_size, num_workers=num_workers)
+        elapsed = time.perf_counter() - start
+        print(f"  {num_workers:>7} {len(captions) / elapsed:11.0f} {serial / elapsed:8.2f}")
+
+
+# imports the tokenizer module on its own, since importing the clip package already builds a tokenizer
+_CONSTRUCT = """
+import os, sys, time
+sys.path.insert(0, "clip")
+from simple_tokenizer import SimpleTokenizer
+def rss():
+    return int(open("/proc/self/statm").read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+before = rss()
+start = time.perf_counter()
+tokenizer = SimpleTokenizer(sys.argv[1])
+print(time.perf_counter() - start, rss() - before)
+"""
+
+
+def construction_benchmark(repeat):
+    """Construct a tokenizer in fresh processes from the gzipped and the compiled vocabulary"""
+    with tempfile.TemporaryDirectory() as root:
+        compiled_path = os.path.join(root, "bpe_simple_vocab_16e6.bin")
+        compile_bpe(default_bpe(), compiled_path)
+
+        print(f"SimpleTokenizer() in a fresh process, best of {repeat}")
+        print(f"  {'format':>8} {'time (ms)':>10} {'RSS growth (MiB)':>17}")
+        for label, path in [("gzip", default_bpe()), ("compiled", compiled_path)]:
+            runs = []
+            for _ in range(repeat):
+                output = subprocess.check_output([sys.executable, "-c", _CONSTRUCT, path], text=True)
+                runs.append([float(v) for v in output.split()])
+            elapsed, rss = min(runs)
+            print(f"  {label:>8} {elapsed * 1000:10.1f} {rss / 1024:17.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--num-captions", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cache-sizes", type=lambda s: [None if v == "none" else int(v) for v in s.split(",")], default="0,1024,16384,none")
+    parser.add_argument("--warm-cache", type=int, default=0)
+    parser.add_argument("--workers", type=lambda s: [int(v) for v in s.split(",")], default=",".join(str(2 ** i) for i in range(os.cpu_count().bit_length())))
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    construction_benchmark(args.repeat)
+
+    captions = synthetic_captions(args.num_captions)
+
+    tokenizer = SimpleTokenizer()
+    reference = SimpleTokenizer()
+    reference.bpe = lambda token: reference_bpe(reference, token)
+
+    tokens = sorted({
+        token.encode('utf-8').decode('latin-1').translate(tokenizer.byte_table)
+        for caption in captions for token in tokenizer.pat.findall(caption.lower())
+    })
+    heap_time = time_bpe(lambda token: (tokenizer.clear_cache(), tokenizer.bpe(token)), tokens, args.repeat)
+    reference_time = time_bpe(lambda token: reference_bpe(reference, token), tokens, args.repeat)
+    print(f"bpe only, {len(tokens)} unique tokens")
+    print(f"  reference merge loop : {reference_time * 1000:8.1f} ms")
+    print(f"  heap merge engine    : {heap_time * 1000:8.1f} ms  ({reference_time / heap_time:.2f}x)")
+
+    heap_time = time_encode(tokenizer, captions, args.repeat)
+    reference_time = time_encode(reference, captions, args.repeat)
+    print(f"encode (cold cache), {len(captions)} captions")
+    print(f"  reference merge loop : {reference_time * 1000:8.1f} ms")
+    print(f"  heap merge engine    : {heap_time * 1000:8.1f} ms  ({reference_time / heap_time:.2f}x)")
+
+    cache_sweep(zipf_stream(captions, 4 * len(captions)), args.cache_sizes, args.warm_cache)
+    worker_sweep(synthetic_captions(20 * args.num_captions, seed=1), args.workers, args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
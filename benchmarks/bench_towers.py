@@ -0,0 +1,56 @@
+"""
+Memory of single-tower models; run from the repository root with `python -m benchmarks.bench_towers`. Parameter memory
+is counted on the meta device, so it covers every model without allocating it; with --rss, the peak RSS of warm
+clip.load calls is measured in fresh processes on synthetic fp16 checkpoints.
+"""
+import argparse
+import os
+import tempfile
+
+import torch
+
+from benchmarks.bench_load import measure
+from benchmarks.common import MODEL_CONFIGS, synthetic_state_dict
+from clip.model import CLIP, PRECISIONS, TOWERS
+
+
+def parameter_bytes(name: str, towers: str, dtype: torch.dtype) -> int:
+    with torch.device("meta"):
+        model = CLIP(**MODEL_CONFIGS[name], towers=towers)
+    return sum(p.numel() for p in model.parameters()) * dtype.itemsize
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--models", nargs="+", choices=list(MODEL_CONFIGS), default=list(MODEL_CONFIGS))
+    parser.add_argument("--precision", choices=list(PRECISIONS), default="fp16")
+    parser.add_argument("--rss", nargs="*", choices=list(MODEL_CONFIGS), default=["RN50", "ViT-B/32"],
+                        help="models whose clip.load peak RSS is measured for each towers option")
+    args = parser.parse_args()
+
+    dtype = PRECISIONS[args.precision].dtype
+    print(f"{args.precision} parameter memory (MB) per towers option, and the saving against both towers")
+    print(f"  {'model':>9} {'both':>8} {'text':>8} {'vision':>8} {'text saves':>11} {'vision saves':>13}")
+    for name in args.models:
+        sizes = {towers: parameter_bytes(name, towers, dtype) / 2 ** 20 for towers in TOWERS}
+        print(f"  {name:>9} {sizes['both']:8.1f} {sizes['text']:8.1f} {sizes['vision']:8.1f} "
+              f"{1 - sizes['text'] / sizes['both']:11.1%} {1 - sizes['vision'] / sizes['both']:13.1%}")
+
+    if not args.rss:
+        return
+    print(f"peak RSS (MB) of a warm {args.precision} clip.load on the CPU in a fresh process, per towers option")
+    print(f"  {'model':>9} {'both':>8} {'text':>8} {'vision':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint = os.path.join(directory, "checkpoint.pt")
+        for name in args.rss:
+            torch.save({k: v.half() if v.is_floating_point() else v for k, v in synthetic_state_dict(name).items()}, checkpoint)
+            rss = {}
+            for towers in TOWERS:
+                download_root = tempfile.mkdtemp(dir=directory)
+                measure(checkpoint, args.precision, "load", download_root, towers)  # writes the converted checkpoint
+                rss[towers] = measure(checkpoint, args.precision, "load", download_root, towers)["peak_rss"] / 2 ** 20
+            print(f"  {name:>9} {rss['both']:8.0f} {rss['text']:8.0f} {rss['vision']:8.0f}")
+
+
+if __name__ == "__main__":
+    main()
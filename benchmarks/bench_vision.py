@@ -0,0 +1,79 @@
+"""Vision tower benchmarks; run from the repository root with `python -m benchmarks.bench_vision`"""
+import argparse
+from collections import OrderedDict
+
+import torch
+
+from benchmarks.common import MODEL_CONFIGS, benchmark, synthetic_model
+from clip.clip import _MODELS
+from clip.model import resample_positional_embedding
+
+RESNETS = [name for name in _MODELS if name.startswith("RN")]
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--models", nargs="+", choices=list(MODEL_CONFIGS), default=RESNETS)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--resolution", type=lambda s: tuple(int(v) for v in s.split("x")), default=None,
+                        help="input size as HxW, e.g. 720x1280; defaults to each model's native resolution")
+    args = parser.parse_args()
+
+    print(f"encode_image on CPU ({torch.get_num_threads()} threads), batch of {args.batch_size}")
+    print(f"  {'model':>9} {'resolution':>10} {'latency (ms)':>13} {'images/s':>9}")
+    for name in args.models:
+        model = synthetic_model(name)
+        resolution = args.resolution or (model.visual.input_resolution,) * 2
+        images = torch.randn(args.batch_size, 3, *resolution)
+        elapsed = benchmark(model.encode_image, images, repeat=args.repeat)
+        print(f"  {name:>9} {'x'.join(map(str, resolution)):>10} {elapsed * 1000:13.1f} {args.batch_size / elapsed:9.1f}")
+
+    if args.resolution:
+        print(f"positional embedding resampling to {'x'.join(map(str, args.resolution))}")
+        print(f"  {'model':>9} {'uncached (us)':>14} {'cached (us)':>12}")
+        for name in args.models:
+            visual = synthetic_model(name).visual
+            if hasattr(visual, "attnpool"):
+                module, grid = visual.attnpool, [side // 32 for side in args.resolution]
+            else:
+                module, grid = visual, [side // visual.conv1.kernel_size[0] for side in args.resolution]
+            cache = OrderedDict()
+            uncached = benchmark(resample_positional_embedding, module.positional_embedding, grid, torch.float32, repeat=args.repeat)
+            cached = benchmark(resample_positional_embedding, module.positional_embedding, grid, torch.float32, cache, repeat=args.repeat)
+            print(f"  {name:>9} {uncached * 1e6:14.1f} {cached * 1e6:12.1f}")
+
+    resnets = [name for name in args.models if name in RESNETS]
+    print(f"ModifiedResNet.fuse_for_inference, encode_image latency (ms) on a batch of {args.batch_size}")
+    print(f"  {'model':>9} {'unfused':>8} {'fused':>8} {'fused + channels-last':>22} {'max abs diff':>13}")
+    for name in resnets:
+        model = synthetic_model(name)
+        resolution = model.visual.input_resolution
+        images = torch.randn(args.batch_size, 3, resolution, resolution)
+        unfused = benchmark(model.encode_image, images, repeat=args.repeat)
+        with torch.no_grad():
+            expected = model.encode_image(images)
+        model.visual.fuse_for_inference()
+        fused = benchmark(model.encode_image, images, repeat=args.repeat)
+        model.visual.fuse_for_inference(channels_last=True)
+        channels_last = benchmark(model.encode_image, images, repeat=args.repeat)
+        with torch.no_grad():
+            difference = (model.encode_image(images) - expected).abs().max()
+        print(f"  {name:>9} {unfused * 1000:8.1f} {fused * 1000:8.1f} {channels_last * 1000:22.1f} {difference:13.2e}")
+
+    if resnets:
+        resolution = args.resolution or (720, 1280)
+        grid = [side // 32 for side in resolution]
+        print(f"AttentionPool2d on a {'x'.join(map(str, grid))} feature map ({grid[0] * grid[1] + 1} tokens), batch of {args.batch_size}")
+        print(f"  {'model':>9} {'full (ms)':>10} {'pooled-only (ms)':>17} {'speedup':>8}")
+        for name in resnets:
+            attnpool = synthetic_model(name).visual.attnpool
+            features = torch.randn(args.batch_size, attnpool.k_proj.in_features, *grid)
+            with torch.no_grad():
+                full = benchmark(attnpool, features, repeat=args.repeat)
+                pooled = benchmark(attnpool, features, True, repeat=args.repeat)
+            print(f"  {name:>9} {full * 1000:10.1f} {pooled * 1000:17.1f} {full / pooled:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
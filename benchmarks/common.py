@@ -0,0 +1,56 @@
+"""Helpers shared by the benchmark scripts"""
+import time
+
+import torch
+
+from clip.model import CLIP, build_model
+
+# CLIP constructor arguments for every entry in clip.clip._MODELS, so benchmarks can build
+# synthetic models of the real sizes without downloading the checkpoints
+MODEL_CONFIGS = {
+    "RN50": dict(embed_dim=1024, image_resolution=224, vision_layers=(3, 4, 6, 3), vision_width=64, vision_patch_size=None,
+                 context_length=77, vocab_size=49408, transformer_width=512, transformer_heads=8, transformer_layers=12),
+    "RN101": dict(embed_dim=512, image_resolution=224, vision_layers=(3, 4, 23, 3), vision_width=64, vision_patch_size=None,
+                  context_length=77, vocab_size=49408, transformer_width=512, transformer_heads=8, transformer_layers=12),
+    "RN50x4": dict(embed_dim=640, image_resolution=288, vision_layers=(4, 6, 10, 6), vision_width=80, vision_patch_size=None,
+                   context_length=77, vocab_size=49408, transformer_width=640, transformer_heads=10, transformer_layers=12),
+    "RN50x16": dict(embed_dim=768, image_resolution=384, vision_layers=(6, 8, 18, 8), vision_width=96, vision_patch_size=None,
+                    context_length=77, vocab_size=49408, transformer_width=768, transformer_heads=12, transformer_layers=12),
+    "RN50x64": dict(embed_dim=1024, image_resolution=448, vision_layers=(3, 15, 36, 10), vision_width=128, vision_patch_size=None,
+                    context_length=77, vocab_size=49408, transformer_width=1024, transformer_heads=16, transformer_layers=12),
+    "ViT-B/32": dict(embed_dim=512, image_resolution=224, vision_layers=12, vision_width=768, vision_patch_size=32,
+                     context_length=77, vocab_size=49408, transformer_width=512, transformer_heads=8, transformer_layers=12),
+    "ViT-B/16": dict(embed_dim=512, image_resolution=224, vision_layers=12, vision_width=768, vision_patch_size=16,
+                     context_length=77, vocab_size=49408, transformer_width=512, transformer_heads=8, transformer_layers=12),
+    "ViT-L/14": dict(embed_dim=768, image_resolution=224, vision_layers=24, vision_width=1024, vision_patch_size=14,
+                     context_length=77, vocab_size=49408, transformer_width=768, transformer_heads=12, transformer_layers=12),
+}
+
+
+def synthetic_state_dict(name: str) -> dict:
+    """A randomly initialized state dict with the keys and shapes of the named checkpoint, the same on every call"""
+    with torch.random.fork_rng():
+        torch.manual_seed(0)
+        return CLIP(**MODEL_CONFIGS[name]).state_dict()
+
+
+def synthetic_model(name: str, device: str = "cpu", precision: str = None, **kwargs) -> CLIP:
+    """
+    Runs a synthetic state dict through `build_model` with the default precision of `clip.load` for `device`, the
+    same path `clip.load` uses; `kwargs` go to `build_model`
+    """
+    precision = precision or ("fp32" if str(device) == "cpu" else "fp16")
+    return build_model(synthetic_state_dict(name), precision=precision, **kwargs).to(device)
+
+
+def benchmark(fn, *args, warmup: int = 1, repeat: int = 5) -> float:
+    """Best wall-clock time of `fn(*args)` in seconds, under torch.no_grad()"""
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(*args)
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn(*args)
+            best = min(best, time.perf_counter() - start)
+    return best
@@ -0,0 +1,51 @@
+"""Straightforward implementations that the optimized code paths replaced, kept as ground truth for tests and benchmarks"""
+import torch
+
+from clip.simple_tokenizer import get_pairs
+
+
+def reference_bpe(tokenizer, token):
+    """The original rescanning merge loop, kept as the ground truth for SimpleTokenizer.bpe"""
+    word = tuple(token[:-1]) + (token[-1] + '</w>',)
+    pairs = get_pairs(word)
+
+    if not pairs:
+        return token + '</w>'
+
+    while True:
+        bigram = min(pairs, key=lambda pair: tokenizer.bpe_ranks.get(pair, float('inf')))
+        if bigram not in tokenizer.bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except ValueError:
+                new_word.extend(word[i:])
+                break
+
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+        if len(word) == 1:
+            break
+        else:
+            pairs = get_pairs(word)
+    return ' '.join(word)
+
+
+def reference_encode_text(model, text):
+    """encode_text computing every position of every layer, as it did before the eot-only last layer"""
+    x = model.token_embedding(text).type(model.dtype)
+    x = x + model.positional_embedding[:text.shape[1]].type(model.dtype)
+    x = model.transformer(x.permute(1, 0, 2)).permute(1, 0, 2)
+    x = model.ln_final(x).type(model.dtype)
+    return x[torch.arange(x.shape[0]), text.argmax(dim=-1)] @ model.text_projection
@@ -1 +1,6 @@
 from .clip import *
+from .text_cache import *
+from .zeroshot import *
+from .export import *
+from .registry import *
+from .preprocess import *
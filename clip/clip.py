@@ -1,16 +1,24 @@
 import hashlib
+import inspect
+import itertools
+import json
 import os
-import urllib
+import urllib.error
+import urllib.request
 import warnings
-from typing import Any, Union, List
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Union, List, Iterable, Iterator
 from pkg_resources import packaging
 
+import numpy as np
 import torch
 from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from tqdm import tqdm
 
-from .model import build_model
+from .model import build_model, quantize_int8
+from .preprocess import IMAGE_MEAN, IMAGE_STD
 from .simple_tokenizer import SimpleTokenizer as _Tokenizer
 
 try:
@@ -24,7 +32,7 @@ if packaging.version.parse(torch.__version__) < packaging.version.parse("1.7.1")
     warnings.warn("PyTorch version 1.7.1 or higher is recommended")
 
 
-__all__ = ["available_models", "load", "tokenize"]
+__all__ = ["available_models", "load", "tokenize", "tokenize_iter", "tokenize_batch"]
 _tokenizer = _Tokenizer()
 
 _MODELS = {
@@ -39,6 +47,35 @@ _MODELS = {
 }
 
 
+def _sha256(path: str, digest=None, chunk_size: int = 1 << 20):
+    """Streams the file at `path` through a SHA256 digest (or updates `digest`), without reading it into memory at once"""
+    digest = digest or hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest
+
+
+def _sidecar_record(path: str, sha256: str) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+
+
+def _is_verified(path: str, sha256: str) -> bool:
+    """Whether the sidecar written by `_mark_verified` still describes the file, so it needn't be hashed again"""
+    try:
+        with open(path + ".verified") as f:
+            return json.load(f) == _sidecar_record(path, sha256)
+    except (OSError, ValueError):
+        return False
+
+
+def _mark_verified(path: str, sha256: str):
+    with open(path + ".verified.tmp", "w") as f:
+        json.dump(_sidecar_record(path, sha256), f)
+    os.replace(path + ".verified.tmp", path + ".verified")
+
+
 def _download(url: str, root: str):
     os.makedirs(root, exist_ok=True)
     filename = os.path.basename(url)
@@ -50,27 +87,89 @@ def _download(url: str, root: str):
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        if hashlib.sha256(open(download_target, "rb").read()).hexdigest() == expected_sha256:
+        if _is_verified(download_target, expected_sha256):
+            return download_target
+        if _sha256(download_target).hexdigest() == expected_sha256:
+            _mark_verified(download_target, expected_sha256)
             return download_target
         else:
             warnings.warn(f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file")
 
-    with urllib.request.urlopen(url) as source, open(download_target, "wb") as output:
-        with tqdm(total=int(source.info().get("Content-Length")), ncols=80, unit='iB', unit_scale=True, unit_divisor=1024) as loop:
-            while True:
-                buffer = source.read(8192)
-                if not buffer:
-                    break
-
-                output.write(buffer)
-                loop.update(len(buffer))
+    # the file is downloaded to a .part file, which an interrupted download leaves behind for the next attempt to resume
+    # with an HTTP Range request, and only renamed into place once its checksum matches
+    partial_target = download_target + ".part"
+    offset = os.path.getsize(partial_target) if os.path.isfile(partial_target) else 0
+    request = urllib.request.Request(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+    try:
+        source = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code != 416:  # 416: nothing left after the offset, so the .part file is already complete
+            raise
+        source = None
+
+    if source is not None:
+        with source:
+            if offset and source.status != 206:  # the server ignored the Range header and sends the whole file
+                offset = 0
+            digest = _sha256(partial_target) if offset else hashlib.sha256()
+            length = source.info().get("Content-Length")
+            with open(partial_target, "ab" if offset else "wb") as output, \
+                    tqdm(total=offset + int(length) if length else None, initial=offset, ncols=80, unit='iB', unit_scale=True, unit_divisor=1024) as loop:
+                while True:
+                    buffer = source.read(1 << 16)
+                    if not buffer:
+                        break
+
+                    output.write(buffer)
+                    digest.update(buffer)
+                    loop.update(len(buffer))
+    else:
+        digest = _sha256(partial_target)
 
-    if hashlib.sha256(open(download_target, "rb").read()).hexdigest() != expected_sha256:
+    if digest.hexdigest() != expected_sha256:
+        os.remove(partial_target)
         raise RuntimeError(f"Model has been downloaded but the SHA256 checksum does not not match")
 
+    os.replace(partial_target, download_target)
+    _mark_verified(download_target, expected_sha256)
     return download_target
 
 
+def _converted_path(name: str, root: str, precision: str, towers: str = "both") -> str:
+    """
+    Where `load` caches the state dict of the model built from `name` in `precision` with `towers`: keyed by the
+    checkpoint's SHA256 for the released models, and by the path, size and modification time of a local checkpoint
+    """
+    if name in _MODELS:
+        key = _MODELS[name].split("/")[-2]
+    else:
+        stat = os.stat(name)
+        key = hashlib.sha256(f"{os.path.realpath(name)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    suffix = "" if towers == "both" else f"-{towers}"
+    return os.path.join(root, "converted", f"{key}-{precision}{suffix}.pt")
+
+
+def _load_converted(path: str):
+    """Memory-maps a state dict written by `_save_converted`, or returns None if there is no usable one"""
+    if not os.path.isfile(path):
+        return None
+    kwargs = {"mmap": True, "weights_only": True} if "mmap" in inspect.signature(torch.load).parameters else {}
+    try:
+        return torch.load(path, map_location="cpu", **kwargs)
+    except Exception as e:
+        warnings.warn(f"Could not read the converted checkpoint {path} ({e}); rebuilding it")
+        return None
+
+
+def _save_converted(model: torch.nn.Module, path: str):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        torch.save(model.state_dict(), path + ".tmp")
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        warnings.warn(f"Could not write the converted checkpoint {path} ({e})")
+
+
 def _convert_image_to_rgb(image):
     return image.convert("RGB")
 
@@ -81,7 +180,7 @@ def _transform(n_px):
         CenterCrop(n_px),
         _convert_image_to_rgb,
         ToTensor(),
-        Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711)),
+        Normalize(IMAGE_MEAN, IMAGE_STD),
     ])
 
 
@@ -90,7 +189,7 @@ def available_models() -> List[str]:
     return list(_MODELS.keys())
 
 
-def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", jit: bool = False, download_root: str = None):
+def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", jit: bool = False, download_root: str = None, attention: str = "mha", quantize: str = None, precision: str = None, cache: bool = False, towers: str = "both"):
     """Load a CLIP model
 
     Parameters
@@ -107,37 +206,76 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     download_root: str
         path to download the model files; by default, it uses "~/.cache/clip"
 
+    attention : str
+        The attention backend of the non-JIT model: "mha" (default) for torch's multi-head attention modules, or
+        "sdpa" for F.scaled_dot_product_attention with precomputed packed projections; see `CLIP.set_attention_backend`
+
+    quantize : str
+        "int8" applies dynamic int8 quantization to the transformers' Linear layers and the output projections of
+        the non-JIT model for CPU inference; see `clip.model.quantize_int8`. Requires device="cpu".
+
+    precision : str
+        The precision of the non-JIT model, a key of `clip.model.PRECISIONS`: "fp32", "fp16" or "bf16" (whose
+        LayerNorms also run in bf16); by default "fp32" on the CPU and "fp16" elsewhere
+
+    cache : bool
+        Whether the non-JIT model's state dict, already converted to `precision`, is saved under
+        `download_root`/converted on the first load and memory-mapped by later ones, which then skip parsing the
+        JIT archive and converting its weights; off by default, since it stores a second copy of the checkpoint.
+        A cache that can't be written only warns.
+
+    towers : str
+        "text" or "vision" builds a non-JIT model with only the tower that `encode_text` or `encode_image` needs,
+        without converting or keeping the other tower's weights; the converted checkpoint cache then holds only
+        that tower, so warm loads don't read the other one at all. "both" (default) builds the full model.
+
     Returns
     -------
     model : torch.nn.Module
         The CLIP model
 
     preprocess : Callable[[PIL.Image], torch.Tensor]
-        A torchvision transform that converts a PIL image into a tensor that the returned model can take as its input
+        A torchvision transform that converts a PIL image into a tensor that the returned model can take as its
+        input, or None for a text-only model
     """
-    if name in _MODELS:
-        model_path = _download(_MODELS[name], download_root or os.path.expanduser("~/.cache/clip"))
-    elif os.path.isfile(name):
-        model_path = name
-    else:
+    if quantize not in (None, "int8"):
+        raise ValueError(f"Unknown quantization {quantize!r}; supported: 'int8'")
+    if precision is None:
+        precision = "fp32" if str(device) == "cpu" else "fp16"
+    if quantize is not None and (jit or torch.device(device).type != "cpu" or precision != "fp32"):
+        raise ValueError("Dynamic int8 quantization needs a non-JIT fp32 model on the CPU")
+    if towers != "both" and jit:
+        raise ValueError(f"towers={towers!r} needs a non-JIT model")
+
+    download_root = download_root or os.path.expanduser("~/.cache/clip")
+    if name not in _MODELS and not os.path.isfile(name):
         raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
 
-    try:
-        # loading JIT archive
-        model = torch.jit.load(model_path, map_location=device if jit else "cpu").eval()
-        state_dict = None
-    except RuntimeError:
-        # loading saved state dict
-        if jit:
-            warnings.warn(f"File {model_path} is not a JIT archive. Loading as a state dict instead")
-            jit = False
-        state_dict = torch.load(model_path, map_location="cpu")
+    converted_path = _converted_path(name, download_root, precision, towers) if cache and not jit else None
+    state_dict = _load_converted(converted_path) if converted_path else None
+    converted = state_dict is not None
+
+    if not converted:
+        model_path = _download(_MODELS[name], download_root) if name in _MODELS else name
+        try:
+            # loading JIT archive
+            model = torch.jit.load(model_path, map_location=device if jit else "cpu").eval()
+            state_dict = None
+        except RuntimeError:
+            # loading saved state dict
+            if jit:
+                warnings.warn(f"File {model_path} is not a JIT archive. Loading as a state dict instead")
+                jit = False
+            state_dict = torch.load(model_path, map_location="cpu")
 
     if not jit:
-        model = build_model(state_dict or model.state_dict()).to(device)
-        if str(device) == "cpu":
-            model.float()
-        return model, _transform(model.visual.input_resolution)
+        model = build_model(state_dict or model.state_dict(), attention=attention, precision=precision, towers=towers)
+        if converted_path and not converted:
+            _save_converted(model, converted_path)
+        model = model.to(device)
+        if quantize == "int8":
+            quantize_int8(model)
+        return model, _transform(model.visual.input_resolution) if model.visual is not None else None
 
     # patch the device names
     device_holder = torch.jit.trace(lambda: torch.ones([]).to(torch.device(device)), example_inputs=[])
@@ -192,7 +330,7 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     return model, _transform(model.input_resolution.item())
 
 
-def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False) -> torch.LongTensor:
+def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False, trim: bool = False, return_lengths: bool = False) -> torch.LongTensor:
     """
     Returns the tokenized representation of given input string(s)
 
@@ -207,25 +345,122 @@ def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: b
     truncate: bool
         Whether to truncate the text in case its encoding is longer than the context length
 
+    trim: bool
+        Whether to drop the padding columns past the longest sequence in the batch; `encode_text` accepts
+        sequences shorter than the context length and returns the same features for them
+
+    return_lengths: bool
+        Whether to also return the number of tokens in each row, including the start and end tokens
+
     Returns
     -------
-    A two-dimensional tensor containing the resulting tokens, shape = [number of input strings, context_length]
+    A two-dimensional tensor containing the resulting tokens, shape = [number of input strings, context_length],
+    or [number of input strings, longest sequence length] when `trim` is set.
+    If `return_lengths` is set, a tuple of that tensor and a LongTensor of row lengths, shape = [number of input strings]
     """
     if isinstance(texts, str):
         texts = [texts]
 
-    sot_token = _tokenizer.encoder["<|startoftext|>"]
-    eot_token = _tokenizer.encoder["<|endoftext|>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
-    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
+    result = torch.zeros(len(texts), context_length, dtype=torch.long)
+    lengths = _tokenize_into(_tokenizer, texts, result.numpy(), truncate)
+
+    if trim:
+        result = result[:, :max(lengths, default=0)].contiguous()
+    if return_lengths:
+        return result, torch.tensor(lengths, dtype=torch.long)
+    return result
+
 
-    for i, tokens in enumerate(all_tokens):
+def _tokenize_into(tokenizer: _Tokenizer, texts: List[str], result: np.ndarray, truncate: bool) -> List[int]:
+    """Write the tokens of each text into the matching row of a zero-initialized int64 array and return the row lengths"""
+    context_length = result.shape[1]
+    sot_token = tokenizer.encoder["<|startoftext|>"]
+    eot_token = tokenizer.encoder["<|endoftext|>"]
+
+    lengths = []
+    for i, text in enumerate(texts):
+        tokens = [sot_token] + tokenizer.encode(text) + [eot_token]
         if len(tokens) > context_length:
             if truncate:
                 tokens = tokens[:context_length]
                 tokens[-1] = eot_token
             else:
-                raise RuntimeError(f"Input {texts[i]} is too long for context length {context_length}")
-        result[i, :len(tokens)] = torch.tensor(tokens)
+                raise RuntimeError(f"Input {text} is too long for context length {context_length}")
+        result[i, :len(tokens)] = tokens
+        lengths.append(len(tokens))
+    return lengths
+
+
+def _tokenize_chunk(texts: List[str], context_length: int, truncate: bool) -> np.ndarray:
+    # runs inside the worker processes, each of which has its own module-level tokenizer and cache
+    result = np.zeros((len(texts), context_length), dtype=np.int64)
+    _tokenize_into(_tokenizer, texts, result, truncate)
+    return result
+
+
+def tokenize_iter(texts: Union[str, Iterable[str]], context_length: int = 77, truncate: bool = False, chunk_size: int = 1024, num_workers: int = None) -> Iterator[torch.LongTensor]:
+    """
+    Tokenizes a (possibly unbounded) stream of strings in parallel, preserving the input order
+
+    Parameters
+    ----------
+    texts : Union[str, Iterable[str]]
+        An input string or strings; only about `2 * num_workers` chunks of them are held in memory at a time
+
+    context_length : int
+        The context length to use; all CLIP models use 77 as the context length
 
+    truncate: bool
+        Whether to truncate the text in case its encoding is longer than the context length
+
+    chunk_size : int
+        The number of strings tokenized per task, and the number of rows in each yielded tensor
+
+    num_workers : int
+        The number of tokenizer processes; defaults to the number of CPUs, and 0 tokenizes in the calling process
+
+    Returns
+    -------
+    An iterator of two-dimensional tensors, shape = [chunk_size, context_length], the last of which may be shorter
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    texts = iter(texts)
+    chunks = iter(lambda: list(itertools.islice(texts, chunk_size)), [])
+
+    if num_workers == 0:
+        for chunk in chunks:
+            yield torch.from_numpy(_tokenize_chunk(chunk, context_length, truncate))
+        return
+
+    num_workers = num_workers or os.cpu_count()
+    with ProcessPoolExecutor(num_workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_tokenize_chunk, chunk, context_length, truncate))
+            if len(pending) >= 2 * num_workers:
+                yield torch.from_numpy(pending.popleft().result())
+        while pending:
+            yield torch.from_numpy(pending.popleft().result())
+
+
+def tokenize_batch(texts: Union[str, Iterable[str]], context_length: int = 77, truncate: bool = False, chunk_size: int = 1024, num_workers: int = None) -> torch.LongTensor:
+    """
+    Tokenizes many strings in parallel with `tokenize_iter` and returns them as a single tensor
+
+    Returns
+    -------
+    A two-dimensional tensor containing the resulting tokens, shape = [number of input strings, context_length]
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    chunks = tokenize_iter(texts, context_length, truncate, chunk_size, num_workers)
+    if not hasattr(texts, "__len__"):
+        return torch.cat(list(chunks) or [torch.zeros(0, context_length, dtype=torch.long)])
+
+    result = torch.zeros(len(texts), context_length, dtype=torch.long)
+    offset = 0
+    for chunk in chunks:
+        result[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
     return result
@@ -0,0 +1,164 @@
+import inspect
+import json
+import os
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from .model import CLIP
+
+__all__ = ["export_model", "load_exported"]
+
+EXPORT_FORMATS = ("torchscript", "onnx")
+
+
+class _ImageEncoder(nn.Module):
+    def __init__(self, model: CLIP):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image: torch.Tensor):
+        return self.model.encode_image(image)
+
+
+class _TextEncoder(nn.Module):
+    def __init__(self, model: CLIP):
+        super().__init__()
+        self.model = model
+
+    def forward(self, text: torch.Tensor):
+        return self.model.encode_text(text)
+
+
+def export_model(model: CLIP, directory: str, format: str = "torchscript", opset_version: int = None) -> Dict[str, str]:
+    """
+    Exports `model.encode_image` and `model.encode_text` as standalone graphs with a dynamic batch size (and text
+    length), which `load_exported` can run without constructing CLIP; a model built with `towers="text"` or
+    `"vision"` exports only that tower's graph
+
+    Parameters
+    ----------
+    model : CLIP
+        A non-JIT model, in the precision and on the device the graphs should run with; images must have its
+        input resolution
+
+    directory : str
+        Where to write image_encoder.{pt,onnx}, text_encoder.{pt,onnx} and the export.json metadata
+
+    format : str
+        "torchscript" for traced TorchScript modules, or "onnx", which needs the optional `onnx` package and
+        PyTorch 2.0 or later
+
+    opset_version : int
+        The ONNX opset to target; by default the installed exporter's default opset
+
+    Returns
+    -------
+    A dict with the paths of the "image" and "text" graphs (of the towers the model has) and the "metadata" file
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {format!r}; available formats = {list(EXPORT_FORMATS)}")
+    if format == "onnx" and not hasattr(F, "scaled_dot_product_attention"):
+        # F.multi_head_attention_forward bakes the example's batch size into its reshapes when exported to ONNX
+        raise RuntimeError(f"ONNX export needs the sdpa attention backend of PyTorch 2.0 or later, found {torch.__version__}")
+    os.makedirs(directory, exist_ok=True)
+
+    device = model.logit_scale.device
+    extension = "pt" if format == "torchscript" else "onnx"
+    paths = {}
+    encoders = []  # (name, encoder, example, dynamic axes) of each tower the model has
+    if model.visual is not None:
+        resolution = model.visual.input_resolution
+        image = torch.randn(2, 3, resolution, resolution, device=device, dtype=model.dtype)
+        paths["image"] = os.path.join(directory, f"image_encoder.{extension}")
+        encoders.append(("image", _ImageEncoder(model).eval(), image, {0: "batch_size"}))
+    if model.transformer is not None:
+        text = torch.randint(1, model.vocab_size - 1, (3, model.context_length), device=device)
+        text[:, -1] = model.vocab_size - 1  # the eot token has the largest id
+        paths["text"] = os.path.join(directory, f"text_encoder.{extension}")
+        encoders.append(("text", _TextEncoder(model).eval(), text, {0: "batch_size", 1: "length"}))
+    paths["metadata"] = os.path.join(directory, "export.json")
+
+    # the TorchScript-based exporter, which newer PyTorch versions only use when asked to
+    onnx_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    backend = next(module.attention_backend for module in model.modules() if hasattr(module, "attention_backend"))
+    if format == "onnx":
+        model.set_attention_backend("sdpa")
+    try:
+        with torch.no_grad():
+            for name, encoder, example, axes in encoders:
+                # fills the model's mask and positional embedding caches, so every traced call sees them
+                embed_dim = encoder(example).shape[1]
+                if format == "torchscript":
+                    torch.jit.save(torch.jit.trace(encoder, example), paths[name])
+                else:
+                    torch.onnx.export(
+                        encoder, (example,), paths[name], input_names=[name], output_names=[f"{name}_features"],
+                        dynamic_axes={name: axes, f"{name}_features": {0: "batch_size"}}, opset_version=opset_version, **onnx_kwargs,
+                    )
+    finally:
+        model.set_attention_backend(backend)
+
+    metadata = {
+        "format": format,
+        "towers": model.towers,
+        "input_resolution": model.visual.input_resolution if model.visual is not None else None,
+        "context_length": model.context_length if model.transformer is not None else None,
+        "dtype": str(model.dtype).replace("torch.", ""),
+        "embed_dim": embed_dim,
+    }
+    with open(paths["metadata"], "w") as f:
+        json.dump(metadata, f, indent=2)
+    return paths
+
+
+def _onnx_runner(path: str, dtype: np.dtype) -> Callable[[torch.Tensor], torch.Tensor]:
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("Running ONNX exports needs the optional onnxruntime package: pip install onnxruntime")
+
+    session = onnxruntime.InferenceSession(path, providers=onnxruntime.get_available_providers())
+    input_name = session.get_inputs()[0].name
+
+    def run(x: torch.Tensor) -> torch.Tensor:
+        return torch.from_numpy(session.run(None, {input_name: np.ascontiguousarray(x.cpu().numpy(), dtype=dtype)})[0])
+
+    return run
+
+
+def load_exported(directory: str, device: str = "cpu") -> Tuple[Callable[[torch.Tensor], torch.Tensor], Callable[[torch.Tensor], torch.Tensor], dict]:
+    """
+    Loads graphs written by `export_model`, returning `encode_image` and `encode_text` functions, which take
+    preprocessed images and tokens like the model's methods do, together with the export metadata; the function
+    of a tower the exported model was built without is None. TorchScript graphs run on `device`; ONNX graphs run
+    with onnxruntime's available providers and return CPU tensors.
+    """
+    with open(os.path.join(directory, "export.json")) as f:
+        metadata = json.load(f)
+    towers = metadata.get("towers", "both")
+
+    if metadata["format"] == "onnx":
+        image_dtype = np.dtype(metadata["dtype"]) if metadata["dtype"] != "bfloat16" else np.float32
+        return (_onnx_runner(os.path.join(directory, "image_encoder.onnx"), image_dtype) if towers != "text" else None,
+                _onnx_runner(os.path.join(directory, "text_encoder.onnx"), np.int64) if towers != "vision" else None,
+                metadata)
+
+    image_encoder = torch.jit.load(os.path.join(directory, "image_encoder.pt"), map_location=device).eval() if towers != "text" else None
+    text_encoder = torch.jit.load(os.path.join(directory, "text_encoder.pt"), map_location=device).eval() if towers != "vision" else None
+    dtype = getattr(torch, metadata["dtype"])
+
+    def encode_image(image: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            return image_encoder(image.to(device, dtype))
+
+    def encode_text(text: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            return text_encoder(text.to(device))
+
+    return (encode_image if image_encoder is not None else None,
+            encode_text if text_encoder is not None else None,
+            metadata)
@@ -1,11 +1,19 @@
-from collections import OrderedDict
-from typing import Tuple, Union
+import contextlib
+import inspect
+import warnings
+from collections import OrderedDict, namedtuple
+from typing import Callable, List, Tuple, Union
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
 
+try:
+    from torch.ao.quantization import quantize_dynamic
+except ImportError:  # PyTorch < 1.10
+    from torch.quantization import quantize_dynamic
+
 class MyDataParallel(torch.nn.DataParallel):
     def __getattr__(self, name):
         try:
@@ -59,6 +67,70 @@ class Bottleneck(nn.Module):
         return out
 
 
+def fuse_conv_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> nn.Conv2d:
+    """Returns a convolution computing `bn(conv(x))` with the eval-mode batch norm folded into its weight and bias, computed in fp32"""
+    scale = bn.weight.float() * (bn.running_var.float() + bn.eps).rsqrt()
+    bias = bn.bias.float() - bn.running_mean.float() * scale
+    if conv.bias is not None:
+        bias = bias + conv.bias.float() * scale
+
+    # constructed, then moved: the device and dtype arguments of nn.Conv2d need PyTorch 1.9
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                      dilation=conv.dilation, groups=conv.groups, bias=True).to(device=conv.weight.device, dtype=conv.weight.dtype)
+    with torch.no_grad():
+        fused.weight.copy_(conv.weight.float() * scale[:, None, None, None])
+        fused.bias.copy_(bias)
+    return fused
+
+
+def resample_positional_embedding(positional_embedding: torch.Tensor, grid_size: Tuple[int, int], dtype: torch.dtype, cache: OrderedDict = None, max_cache_entries: int = 8):
+    """
+    Resamples a [1 + grid ** 2, width] positional embedding, whose first row belongs to the class (or mean) token,
+    to a grid_size[0] x grid_size[1] grid by bicubic interpolation over the 2D grid, and casts it to `dtype`.
+
+    With a `cache`, results computed outside of autograd are memoized per grid size, dtype and device, keeping
+    the `max_cache_entries` most recently used ones; in-place updates to the embedding invalidate them.
+    """
+    grid, grid_size = round(int(positional_embedding.shape[0] - 1) ** 0.5), tuple(int(s) for s in grid_size)
+    if grid_size == (grid, grid):
+        return positional_embedding.to(dtype)
+
+    use_cache = cache is not None and not (torch.is_grad_enabled() and positional_embedding.requires_grad)
+    if use_cache:
+        key = (grid_size, dtype, positional_embedding.device, positional_embedding.data_ptr(), positional_embedding._version)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+    width = positional_embedding.shape[1]
+    spatial = positional_embedding[1:].float().reshape(1, grid, grid, width).permute(0, 3, 1, 2)
+    spatial = F.interpolate(spatial, size=grid_size, mode="bicubic", align_corners=False)
+    spatial = spatial.reshape(width, -1).t()
+    result = torch.cat([positional_embedding[:1].float(), spatial]).to(dtype)
+
+    if use_cache:
+        cache[key] = result
+        if len(cache) > max_cache_entries:
+            cache.popitem(last=False)
+    return result
+
+
+ATTENTION_BACKENDS = ("mha", "sdpa")
+
+# the towers a CLIP can be built with: both, or only the one that encode_text or encode_image needs
+TOWERS = ("both", "text", "vision")
+
+
+def _split_heads(x: torch.Tensor, n_head: int) -> torch.Tensor:
+    """LND -> N, n_head, L, D // n_head"""
+    return x.reshape(x.shape[0], x.shape[1], n_head, -1).permute(1, 2, 0, 3)
+
+
+def _merge_heads(x: torch.Tensor) -> torch.Tensor:
+    """N, n_head, L, D // n_head -> LND"""
+    return x.permute(2, 0, 1, 3).reshape(x.shape[2], x.shape[0], -1)
+
+
 class AttentionPool2d(nn.Module):
     def __init__(self, spacial_dim: int, embed_dim: int, num_heads: int, output_dim: int = None):
         super().__init__()
@@ -68,18 +140,34 @@ class AttentionPool2d(nn.Module):
         self.v_proj = nn.Linear(embed_dim, embed_dim)
         self.c_proj = nn.Linear(embed_dim, output_dim or embed_dim)
         self.num_heads = num_heads
-
-    def forward(self, x):
+        self._positional_embedding_cache = OrderedDict()  # resampled embeddings for non-native feature map sizes
+        # "mha" runs F.multi_head_attention_forward; "sdpa" runs F.scaled_dot_product_attention on the packed
+        # q/k/v projection below, which `pack_in_projection` snapshots from q_proj, k_proj and v_proj
+        self.attention_backend = "mha"
+        self.register_buffer("in_proj_weight", None, persistent=False)
+        self.register_buffer("in_proj_bias", None, persistent=False)
+
+    def pack_in_projection(self):
+        """Concatenates the q/k/v projections for the "sdpa" backend; call again after changing their weights"""
+        with torch.no_grad():
+            self.in_proj_weight = torch.cat([self.q_proj.weight, self.k_proj.weight, self.v_proj.weight])
+            self.in_proj_bias = torch.cat([self.q_proj.bias, self.k_proj.bias, self.v_proj.bias])
+
+    def forward(self, x, pooled_only: bool = False):
+        """
+        Returns the attention-pooled sequence, shape = [HW+1, batch_size, output_dim], whose first row is the pooled
+        embedding; with `pooled_only`, the mean token is the only query and just that row is computed, shape = [1, batch_size, output_dim]
+        """
+        grid_size = x.shape[2:]
         x = x.reshape(x.shape[0], x.shape[1], x.shape[2] * x.shape[3]).permute(2, 0, 1)  # NCHW -> (HW)NC
         x = torch.cat([x.mean(dim=0, keepdim=True), x], dim=0)  # (HW+1)NC
-        # x = x + self.positional_embedding[:, None, :].to(x.dtype)  # (HW+1)NC
-        temp = self.positional_embedding[:, None, :].to(x.dtype)
-        temp = temp.permute(2,1,0)
-        temp = F.interpolate(temp, size=x.shape[0], mode='linear').permute(2,1,0)
+        positional_embedding = resample_positional_embedding(self.positional_embedding, grid_size, x.dtype, self._positional_embedding_cache)
+        x = x + positional_embedding[:, None, :]  # (HW+1)NC
+        if self.attention_backend == "sdpa":
+            return self._sdpa(x, pooled_only)
 
-        x = x + temp
         x, _ = F.multi_head_attention_forward(
-            query=x, key=x, value=x,
+            query=x[:1] if pooled_only else x, key=x, value=x,
             embed_dim_to_check=x.shape[-1],
             num_heads=self.num_heads,
             q_proj_weight=self.q_proj.weight,
@@ -100,6 +188,22 @@ class AttentionPool2d(nn.Module):
 
         return x
 
+    def _sdpa(self, x: torch.Tensor, pooled_only: bool):
+        weight, bias = self.in_proj_weight, self.in_proj_bias
+        if weight is None:
+            weight = torch.cat([self.q_proj.weight, self.k_proj.weight, self.v_proj.weight])
+            bias = torch.cat([self.q_proj.bias, self.k_proj.bias, self.v_proj.bias])
+
+        width = x.shape[-1]
+        if pooled_only:
+            q = F.linear(x[:1], weight[:width], bias[:width])
+            k, v = F.linear(x, weight[width:], bias[width:]).chunk(2, dim=-1)
+        else:
+            q, k, v = F.linear(x, weight, bias).chunk(3, dim=-1)
+
+        x = F.scaled_dot_product_attention(*[_split_heads(t, self.num_heads) for t in (q, k, v)])
+        return self.c_proj(_merge_heads(x))
+
 
 class ModifiedResNet(nn.Module):
     """
@@ -134,6 +238,34 @@ class ModifiedResNet(nn.Module):
         embed_dim = width * 32  # the ResNet feature dimension
         self.attnpool = AttentionPool2d(input_resolution // 32, embed_dim, heads, output_dim)
 
+        # opt-in diagnostics: when set, called as debug_hook(stage_name, output) after every stage of forward()
+        self.debug_hook: Callable[[str, torch.Tensor], None] = None
+        self.channels_last = False  # set by fuse_for_inference()
+
+    def fuse_for_inference(self, channels_last: bool = False):
+        """
+        Folds every batch norm, in the stem, the bottlenecks and their downsample branches, into the convolution
+        before it, leaving an nn.Identity in its place, and optionally switches the convolutions and their inputs
+        to the channels-last memory format. Only for inference: the result has no batch norm left to train and
+        its state_dict no longer matches the checkpoint's.
+        """
+        pairs = [(self, "conv1", "bn1"), (self, "conv2", "bn2"), (self, "conv3", "bn3")]
+        for layer in [self.layer1, self.layer2, self.layer3, self.layer4]:
+            for block in layer:
+                pairs += [(block, "conv1", "bn1"), (block, "conv2", "bn2"), (block, "conv3", "bn3")]
+                if block.downsample is not None:
+                    pairs.append((block.downsample, "0", "1"))
+
+        for module, conv, bn in pairs:
+            if isinstance(getattr(module, bn), nn.BatchNorm2d):
+                setattr(module, conv, fuse_conv_bn(getattr(module, conv), getattr(module, bn)))
+                setattr(module, bn, nn.Identity())
+
+        self.channels_last = channels_last
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        return self
+
     def _make_layer(self, planes, blocks, stride=1):
         layers = [Bottleneck(self._inplanes, planes, stride)]
 
@@ -143,30 +275,47 @@ class ModifiedResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def forward(self, x):
+    def forward(self, x, dense: bool = False):
+        """
+        Returns the pooled image embedding, shape = [batch_size, output_dim], or with `dense` a tuple of it and
+        the attention-pooled feature at every location of the final feature map, shape = [batch_size, H, W, output_dim]
+        """
         def stem(x):
             for conv, bn in [(self.conv1, self.bn1), (self.conv2, self.bn2), (self.conv3, self.bn3)]:
-                x = x.cuda()
                 x = self.relu(bn(conv(x)))
             x = self.avgpool(x)
             return x
 
         x = x.type(self.conv1.weight.dtype)
-        x = stem(x)
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
-        x = self.attnpool(x)
-        print('output size: ', x.size())
-
-        return x
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        for name, stage in [("stem", stem), ("layer1", self.layer1), ("layer2", self.layer2),
+                            ("layer3", self.layer3), ("layer4", self.layer4)]:
+            x = stage(x)
+            if self.debug_hook is not None:
+                self.debug_hook(name, x)
+
+        batch_size, _, height, width = x.shape
+        # (HW+1)NC, the pooled embedding followed by one row per location; when only the pooled embedding is
+        # needed, its query alone is attended, which is linear rather than quadratic in the number of locations
+        x = self.attnpool(x, pooled_only=not dense)
+        if self.debug_hook is not None:
+            self.debug_hook("attnpool", x)
+
+        if dense:
+            return x[0], x[1:].permute(1, 0, 2).reshape(batch_size, height, width, -1)
+        return x[0]
 
 
 class LayerNorm(nn.LayerNorm):
     """Subclass torch's LayerNorm to handle fp16."""
 
+    # computes in fp32 unless `native` is set, in which case the weights must have the input's dtype
+    native = False
+
     def forward(self, x: torch.Tensor):
+        if self.native or x.dtype == torch.float32:
+            return super().forward(x)
         orig_type = x.dtype
         ret = super().forward(x.type(torch.float32))
         return ret.type(orig_type)
@@ -177,6 +326,38 @@ class QuickGELU(nn.Module):
         return x * torch.sigmoid(1.702 * x)
 
 
+def merge_tokens(x: torch.Tensor, size: torch.Tensor, metric: torch.Tensor, r: int):
+    """
+    Merges the `r` most similar pairs of tokens by bipartite soft matching (Bolya et al., "Token Merging: Your ViT
+    But Faster"): the tokens are split into alternating sets A and B, each token of A is paired with its most
+    similar token of B by cosine similarity of `metric`, and the `r` best pairs are averaged weighted by `size`,
+    the number of input patches each token stands for. The first (class) token is never merged.
+
+    x, shape = [batch_size, L, width], size, shape = [batch_size, L, 1], metric, shape = [batch_size, L, C];
+    returns the merged x and size, with L - r tokens
+    """
+    metric = metric[:, 1:] / metric[:, 1:].norm(dim=-1, keepdim=True)
+    a, b = metric[:, ::2], metric[:, 1::2]
+    r = min(r, b.shape[1])
+    if r <= 0:
+        return x, size
+
+    best_score, best_index = (a @ b.transpose(1, 2)).max(dim=-1)  # the best partner in B of every token of A
+    order = best_score.argsort(dim=-1, descending=True)[..., None]
+    kept, merged = order[:, r:], order[:, :r]
+    destination = best_index[..., None].gather(1, merged)
+
+    def merge(t: torch.Tensor):
+        head, src, dst = t[:, :1], t[:, 1::2], t[:, 2::2]
+        n, _, c = src.shape
+        dst = dst.scatter_add(1, destination.expand(n, r, c), src.gather(1, merged.expand(n, r, c)))
+        return torch.cat([head, src.gather(1, kept.expand(n, kept.shape[1], c)), dst], dim=1)
+
+    x = merge(x * size)
+    size = merge(size)
+    return x / size, size
+
+
 class ResidualAttentionBlock(nn.Module):
     def __init__(self, d_model: int, n_head: int, attn_mask: torch.Tensor = None):
         super().__init__()
@@ -190,16 +371,158 @@ class ResidualAttentionBlock(nn.Module):
         ]))
         self.ln_2 = LayerNorm(d_model)
         self.attn_mask = attn_mask
+        # "mha" runs nn.MultiheadAttention; "sdpa" runs F.scaled_dot_product_attention on the same packed in_proj_weight
+        self.attention_backend = "mha"
+        self._attn_mask_source = None
+        self._attn_mask_cache = {}  # attn_mask converted per (dtype, device)
+        self._attn_mask_is_causal = False
+        # an nn.Linear standing in for attn.in_proj_weight and attn.in_proj_bias, set by `quantize_int8`
+        self.in_proj_linear: nn.Module = None
+
+    def mask(self, dtype: torch.dtype, device: torch.device):
+        """`attn_mask` in the given dtype and on the given device, converted once and cached"""
+        if self.attn_mask is None:
+            return None
+        if self._attn_mask_source is not self.attn_mask:
+            self._attn_mask_source = self.attn_mask
+            self._attn_mask_cache = {}
+            causal = torch.full_like(self.attn_mask, float("-inf")).triu(1)
+            self._attn_mask_is_causal = self.attn_mask.dim() == 2 and torch.equal(self.attn_mask, causal)
+        key = (dtype, torch.device(device))
+        mask = self._attn_mask_cache.get(key)
+        if mask is None:
+            mask = self._attn_mask_cache[key] = self.attn_mask.to(dtype=dtype, device=device)
+        return mask
 
     def attention(self, x: torch.Tensor):
-        self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
+        attn_mask = self.mask(x.dtype, x.device)
+        attn_mask = attn_mask[:x.shape[0], :x.shape[0]] if attn_mask is not None else None  # sequences may be shorter than the context
+        if self.attention_backend == "sdpa" and self._attn_mask_is_causal:
+            # lets the fused kernels skip the masked half instead of reading an explicit mask
+            x = F.scaled_dot_product_attention(*[_split_heads(t, self.attn.num_heads) for t in self.in_projection(x)], is_causal=True)
+            return self.attn.out_proj(_merge_heads(x))
+        if self.attention_backend == "sdpa" or self.in_proj_linear is not None:
+            return self.multi_head_attention(*self.in_projection(x), attn_mask)
+        return self.attn(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
+
+    def in_projection(self, x: torch.Tensor):
+        """The attention queries, keys and values of (already layer-normed) LND inputs"""
+        if self.in_proj_linear is not None:
+            return self.in_proj_linear(x).chunk(3, dim=-1)
+        return F.linear(x, self.attn.in_proj_weight, self.attn.in_proj_bias).chunk(3, dim=-1)
+
+    def multi_head_attention(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, attn_mask: torch.Tensor = None):
+        """
+        Attention of projected LND queries over projected keys and values, followed by the output projection;
+        `attn_mask` is additive, either shared, shape = [Lq, Lk], or per sequence and head, shape = [batch_size * n_head, Lq, Lk]
+        """
+        n_head = self.attn.num_heads
+        batch_size, width = q.shape[1], q.shape[2]
+        if self.attention_backend == "sdpa":
+            if attn_mask is not None and attn_mask.dim() == 3:
+                attn_mask = attn_mask.reshape(batch_size, n_head, *attn_mask.shape[1:])
+            x = F.scaled_dot_product_attention(*[_split_heads(t, n_head) for t in (q, k, v)], attn_mask=attn_mask)
+            return self.attn.out_proj(_merge_heads(x))
+
+        q = q.reshape(q.shape[0], batch_size * n_head, width // n_head).transpose(0, 1) * (width // n_head) ** -0.5
+        k = k.reshape(k.shape[0], batch_size * n_head, width // n_head).transpose(0, 1)
+        v = v.reshape(v.shape[0], batch_size * n_head, width // n_head).transpose(0, 1)
+
+        attn = q @ k.transpose(1, 2)
+        if attn_mask is not None:
+            attn = attn + attn_mask
+        x = attn.softmax(dim=-1) @ v
+        x = x.transpose(0, 1).reshape(-1, batch_size, width)
+        return self.attn.out_proj(x)
 
     def forward(self, x: torch.Tensor):
         x = x + self.attention(self.ln_1(x))
         x = x + self.mlp(self.ln_2(x))
         return x
 
+    def forward_prefix(self, x: torch.Tensor, kv_only: bool = False):
+        """
+        Runs the block on a prefix shared by a batch of sequences, also returning the prefix's keys and values,
+        which are projected once for both; with `kv_only`, the block's output is skipped and returned as None
+        """
+        q, k, v = self.in_projection(self.ln_1(x))
+        if kv_only:
+            return None, (k, v)
+        attn_mask = self.mask(x.dtype, x.device)
+        attn_mask = attn_mask[:len(x), :len(x)] if attn_mask is not None else None
+        x = x + self.multi_head_attention(q, k, v, attn_mask)
+        x = x + self.mlp(self.ln_2(x))
+        return x, (k, v)
+
+    def forward_suffix(self, x: torch.Tensor, prefix_kv: Tuple[torch.Tensor, torch.Tensor]):
+        """
+        Runs the block on the tokens following a shared prefix, attending over the keys and values returned
+        by `forward_prefix`; the result equals the suffix rows of running the block on the full sequences
+        """
+        prefix_k, prefix_v = prefix_kv
+        q, k, v = self.in_projection(self.ln_1(x))
+        k = torch.cat([prefix_k.expand(-1, x.shape[1], -1), k])
+        v = torch.cat([prefix_v.expand(-1, x.shape[1], -1), v])
+
+        attn_mask = self.mask(x.dtype, x.device)
+        attn_mask = attn_mask[len(prefix_k):len(k), :len(k)] if attn_mask is not None else None
+        x = x + self.multi_head_attention(q, k, v, attn_mask)
+        x = x + self.mlp(self.ln_2(x))
+        return x
+
+    def forward_query(self, x: torch.Tensor, index: torch.Tensor, prefix_kv: Tuple[torch.Tensor, torch.Tensor] = None):
+        """
+        Runs the causal block for a single query position per sequence, given by `index`, and returns only
+        that position's output, shape = [batch_size, width]; keys and values still cover every position up to
+        it, including those of a shared prefix when `prefix_kv` from `forward_prefix` is given
+        """
+        batch_size, width = x.shape[1], x.shape[2]
+        rows = x[index, torch.arange(batch_size, device=x.device)]  # [batch_size, width]
+
+        if self.in_proj_linear is not None:  # a quantized weight can't be split, so project everything and drop the rest
+            q = self.in_proj_linear(self.ln_1(rows))[None, :, :width]
+            k, v = self.in_proj_linear(self.ln_1(x))[..., width:].chunk(2, dim=-1)
+        else:
+            q_weight, kv_weight = self.attn.in_proj_weight.split([width, 2 * width])
+            q_bias, kv_bias = self.attn.in_proj_bias.split([width, 2 * width])
+            q = F.linear(self.ln_1(rows), q_weight, q_bias)[None]
+            k, v = F.linear(self.ln_1(x), kv_weight, kv_bias).chunk(2, dim=-1)
+
+        offset = 0
+        if prefix_kv is not None:
+            prefix_k, prefix_v = prefix_kv
+            offset = len(prefix_k)
+            k = torch.cat([prefix_k.expand(-1, batch_size, -1), k])
+            v = torch.cat([prefix_v.expand(-1, batch_size, -1), v])
+
+        # each query sees the keys up to and including its own position
+        positions = torch.arange(k.shape[0], device=x.device)
+        attn_mask = torch.zeros(batch_size, 1, k.shape[0], dtype=x.dtype, device=x.device)
+        attn_mask.masked_fill_(positions[None, None] > offset + index[:, None, None], float("-inf"))
+
+        rows = rows[None] + self.multi_head_attention(q, k, v, attn_mask.repeat_interleave(self.attn.num_heads, dim=0))
+        rows = rows + self.mlp(self.ln_2(rows))
+        return rows[0]
+
+    def forward_merging(self, x: torch.Tensor, size: torch.Tensor, r: int):
+        """
+        Runs the (unmasked) block on LND tokens that each stand for `size` input patches, shape = [batch_size, L, 1],
+        with attention proportional to `size`, merging the `r` most similar pairs of tokens between the attention
+        and the MLP; returns the merged tokens and their sizes
+        """
+        q, k, v = self.in_projection(self.ln_1(x))
+        # a token standing for s patches gets the attention of s identical ones
+        attn_mask = size.log().transpose(1, 2).repeat_interleave(self.attn.num_heads, dim=0)  # [batch_size * n_head, 1, L]
+        x = x + self.multi_head_attention(q, k, v, attn_mask)
+
+        if r > 0:
+            metric = k.reshape(k.shape[0], k.shape[1], self.attn.num_heads, -1).mean(dim=2)  # keys averaged over heads
+            x, size = merge_tokens(x.transpose(0, 1), size, metric.transpose(0, 1), r)
+            x = x.transpose(0, 1)
+
+        x = x + self.mlp(self.ln_2(x))
+        return x, size
+
 
 class Transformer(nn.Module):
     def __init__(self, width: int, layers: int, heads: int, attn_mask: torch.Tensor = None):
@@ -211,6 +534,48 @@ class Transformer(nn.Module):
     def forward(self, x: torch.Tensor):
         return self.resblocks(x)
 
+    def forward_prefix(self, x: torch.Tensor):
+        """
+        Encodes a shared prefix, returning the per-layer keys and values for `forward_suffix`; the prefix's output
+        of the last layer is never read, so that layer only projects its keys and values
+        """
+        prefix_kv = []
+        for i, block in enumerate(self.resblocks):
+            x, kv = block.forward_prefix(x, kv_only=i == self.layers - 1)
+            prefix_kv.append(kv)
+        return prefix_kv
+
+    def forward_suffix(self, x: torch.Tensor, prefix_kv: list):
+        for block, kv in zip(self.resblocks, prefix_kv):
+            x = block.forward_suffix(x, kv)
+        return x
+
+    def forward_query(self, x: torch.Tensor, index: torch.Tensor, prefix_kv: list = None):
+        """
+        Like `forward` (or `forward_suffix` when `prefix_kv` is given) for a causally masked transformer, but returns
+        only the final hidden state at position `index` of each sequence, shape = [batch_size, width]. No later
+        layer reads the other positions of the last layer, so it only computes the query rows.
+        """
+        *blocks, last = self.resblocks
+        if prefix_kv is None:
+            for block in blocks:
+                x = block(x)
+        else:
+            for block, kv in zip(blocks, prefix_kv):
+                x = block.forward_suffix(x, kv)
+        return last.forward_query(x, index, prefix_kv[-1] if prefix_kv is not None else None)
+
+    def forward_merging(self, x: torch.Tensor, ratios: List[float]):
+        """
+        Like `forward` for an unmasked transformer whose first token is a class token, but after the attention
+        of each block merges the fraction `ratios[i]` (at most half) of the remaining other tokens into their
+        most similar neighbours; see `merge_tokens`. Returns the merged tokens, of which the first is the class token.
+        """
+        size = x.new_ones(x.shape[1], x.shape[0], 1)
+        for block, ratio in zip(self.resblocks, ratios):
+            x, size = block.forward_merging(x, size, int(ratio * (len(x) - 1)))
+        return x
+
 
 class VisionTransformer(nn.Module):
     def __init__(self, input_resolution: int, patch_size: int, width: int, layers: int, heads: int, output_dim: int):
@@ -222,6 +587,7 @@ class VisionTransformer(nn.Module):
         scale = width ** -0.5
         self.class_embedding = nn.Parameter(scale * torch.randn(width))
         self.positional_embedding = nn.Parameter(scale * torch.randn((input_resolution // patch_size) ** 2 + 1, width))
+        self._positional_embedding_cache = OrderedDict()  # resampled embeddings for non-native input sizes
         self.ln_pre = LayerNorm(width)
 
         self.transformer = Transformer(width, layers, heads)
@@ -229,23 +595,44 @@ class VisionTransformer(nn.Module):
         self.ln_post = LayerNorm(width)
         self.proj = nn.Parameter(scale * torch.randn(width, output_dim))
 
-    def forward(self, x: torch.Tensor):
+        # opt-in token merging for the pooled embedding: the fraction of patch tokens merged after every block's
+        # attention, either one ratio for all blocks or a list with one per block; 0 disables it
+        self.token_merging: Union[float, List[float]] = 0.0
+        self.proj_linear: nn.Module = None  # an nn.Linear standing in for proj, set by `quantize_int8`
+
+    def forward(self, x: torch.Tensor, dense: bool = False):
+        """
+        Returns the class-token embedding, shape = [batch_size, output_dim], or with `dense` a tuple of it and
+        the projected patch-token features, shape = [batch_size, grid_height, grid_width, output_dim]; the
+        dense output keeps every patch token, so `token_merging` only applies to the former
+        """
         x = self.conv1(x)  # shape = [*, width, grid, grid]
+        grid = x.shape[-2:]
         x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
         x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
         x = torch.cat([self.class_embedding.to(x.dtype) + torch.zeros(x.shape[0], 1, x.shape[-1], dtype=x.dtype, device=x.device), x], dim=1)  # shape = [*, grid ** 2 + 1, width]
-        x = x + self.positional_embedding.to(x.dtype)
+        x = x + resample_positional_embedding(self.positional_embedding, grid, x.dtype, self._positional_embedding_cache)
         x = self.ln_pre(x)
 
         x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x)
+        ratios = self.token_merging if isinstance(self.token_merging, (list, tuple)) else [self.token_merging] * self.transformer.layers
+        if len(ratios) != self.transformer.layers:
+            raise ValueError(f"token_merging has {len(ratios)} ratios, but the transformer has {self.transformer.layers} blocks")
+        if any(ratios) and not dense:
+            x = self.transformer.forward_merging(x, ratios)
+        else:
+            x = self.transformer(x)
         x = x.permute(1, 0, 2)  # LND -> NLD
 
-        x = self.ln_post(x[:, 0, :])
+        x = self.ln_post(x if dense else x[:, 0, :])
 
-        if self.proj is not None:
+        if self.proj_linear is not None:
+            x = self.proj_linear(x)
+        elif self.proj is not None:
             x = x @ self.proj
 
+        if dense:
+            return x[:, 0], x[:, 1:].reshape(x.shape[0], grid[0], grid[1], -1)
         return x
 
 
@@ -262,13 +649,22 @@ class CLIP(nn.Module):
                  vocab_size: int,
                  transformer_width: int,
                  transformer_heads: int,
-                 transformer_layers: int
+                 transformer_layers: int,
+                 towers: str = "both"
                  ):
         super().__init__()
+        if towers not in TOWERS:
+            raise ValueError(f"Unknown towers {towers!r}; available = {list(TOWERS)}")
 
+        self.towers = towers
+        self.embed_dim = embed_dim
         self.context_length = context_length
 
-        if isinstance(vision_layers, (tuple, list)):
+        # a model built with towers="text" or "vision" has None in place of the other tower's modules and parameters
+        self.visual = self.transformer = self.token_embedding = self.positional_embedding = self.ln_final = self.text_projection = None
+        if towers == "text":
+            pass
+        elif isinstance(vision_layers, (tuple, list)):
             vision_heads = vision_width * 32 // 64
             self.visual = ModifiedResNet(
                 layers=vision_layers,
@@ -288,27 +684,26 @@ class CLIP(nn.Module):
                 output_dim=embed_dim
             )
 
-        self.transformer = Transformer(
-            width=transformer_width,
-            layers=transformer_layers,
-            heads=transformer_heads,
-            attn_mask=self.build_attention_mask()
-        )
-
         self.vocab_size = vocab_size
-        self.token_embedding = nn.Embedding(vocab_size, transformer_width)
-        self.positional_embedding = nn.Parameter(torch.empty(self.context_length, transformer_width))
-        self.ln_final = LayerNorm(transformer_width)
+        if towers != "vision":
+            self.transformer = Transformer(
+                width=transformer_width,
+                layers=transformer_layers,
+                heads=transformer_heads,
+                attn_mask=self.build_attention_mask()
+            )
+
+            self.token_embedding = nn.Embedding(vocab_size, transformer_width)
+            self.positional_embedding = nn.Parameter(torch.empty(self.context_length, transformer_width))
+            self.ln_final = LayerNorm(transformer_width)
 
-        self.text_projection = nn.Parameter(torch.empty(transformer_width, embed_dim))
+            self.text_projection = nn.Parameter(torch.empty(transformer_width, embed_dim))
+        self.text_projection_linear: nn.Module = None  # an nn.Linear standing in for text_projection, set by `quantize_int8`
         self.logit_scale = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
 
         self.initialize_parameters()
 
     def initialize_parameters(self):
-        nn.init.normal_(self.token_embedding.weight, std=0.02)
-        nn.init.normal_(self.positional_embedding, std=0.01)
-
         if isinstance(self.visual, ModifiedResNet):
             if self.visual.attnpool is not None:
                 std = self.visual.attnpool.c_proj.in_features ** -0.5
@@ -322,6 +717,12 @@ class CLIP(nn.Module):
                     if name.endswith("bn3.weight"):
                         nn.init.zeros_(param)
 
+        if self.transformer is None:
+            return
+
+        nn.init.normal_(self.token_embedding.weight, std=0.02)
+        nn.init.normal_(self.positional_embedding, std=0.01)
+
         proj_std = (self.transformer.width ** -0.5) * ((2 * self.transformer.layers) ** -0.5)
         attn_std = self.transformer.width ** -0.5
         fc_std = (2 * self.transformer.width) ** -0.5
@@ -344,28 +745,104 @@ class CLIP(nn.Module):
 
     @property
     def dtype(self):
-        return self.visual.conv1.weight.dtype
+        if self.visual is not None:
+            return self.visual.conv1.weight.dtype
+        # `quantize_int8` drops text_projection, and only applies to fp32 models
+        return self.text_projection.dtype if self.text_projection is not None else torch.float32
+
+    def _require(self, tower: str, module: nn.Module):
+        if module is None:
+            raise RuntimeError(f"This model was built with towers={self.towers!r}, without the {tower} tower")
+
+    def set_attention_backend(self, backend: str):
+        """
+        Switches every attention layer between "mha", the nn.MultiheadAttention and F.multi_head_attention_forward
+        path, and "sdpa", which runs F.scaled_dot_product_attention (fused flash / memory-efficient kernels where
+        available) with the attention-pool projections packed once here; "sdpa" falls back to "mha" with a
+        warning on PyTorch versions without it
+        """
+        if backend not in ATTENTION_BACKENDS:
+            raise ValueError(f"Unknown attention backend {backend!r}; available backends = {list(ATTENTION_BACKENDS)}")
+        if backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+            warnings.warn(f"The sdpa attention backend needs PyTorch 2.0 or later, found {torch.__version__}; using mha instead")
+            backend = "mha"
+
+        for module in self.modules():
+            if isinstance(module, (ResidualAttentionBlock, AttentionPool2d)):
+                module.attention_backend = backend
+            if isinstance(module, AttentionPool2d):
+                if backend == "sdpa":
+                    module.pack_in_projection()
+                else:
+                    module.in_proj_weight = module.in_proj_bias = None
+        return self
 
     def encode_image(self, image):
         #self = MyDataParallel(self, device_ids=[0,1,2,3])
+        self._require("vision", self.visual)
         return self.visual(image.type(self.dtype))
 
-    def encode_text(self, text):
+    def encode_image_dense(self, image):
+        """
+        Returns the pooled image embedding, shape = [batch_size, embed_dim], together with the projected features
+        of every location of the image, shape = [batch_size, H, W, embed_dim], from a single forward pass; (H, W)
+        is the final feature map of a ResNet tower or the patch grid of a ViT tower
+        """
+        self._require("vision", self.visual)
+        return self.visual(image.type(self.dtype), dense=True)
+
+    def encode_text(self, text, share_prefix: bool = False):
+        """
+        Encodes a batch of text tokens. With `share_prefix`, the leading tokens common to every sequence
+        (e.g. "a photo of a" across class prompts) are run through the causal transformer once and their
+        per-layer keys and values are reused for all the suffixes, giving the same features for less compute.
+        """
         #self = MyDataParallel(self, device_ids=[0,1,2,3])
+        self._require("text", self.transformer)
+        if share_prefix:
+            eot = text.argmax(dim=-1)
+            mismatch = (text != text[:1]).any(dim=0).nonzero()
+            prefix_length = min(int(mismatch[0]) if len(mismatch) else text.shape[1], int(eot.min()))
+            if prefix_length > 0:
+                return self.encode_text_suffixes(text[0, :prefix_length], text[:, prefix_length:int(eot.max()) + 1])
+
         x = self.token_embedding(text).type(self.dtype)  # [batch_size, n_ctx, d_model]
 
-        x = x + self.positional_embedding.type(self.dtype)
+        # the mask is causal and the eot token is gathered below, so text trimmed to fewer than
+        # context_length tokens (see `clip.tokenize(..., trim=True)`) encodes to the same features
+        x = x + self.positional_embedding[:x.shape[1]].type(self.dtype)
         x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x)
-        x = x.permute(1, 0, 2)  # LND -> NLD
-        x = self.ln_final(x).type(self.dtype)
+        # take features from the eot embedding (eot_token is the highest number in each sequence);
+        # the last block, ln_final and the projection only run on that row
+        x = self.transformer.forward_query(x, text.argmax(dim=-1))
+        x = self.ln_final(x).type(self.dtype)  # [batch_size, transformer.width]
+        x = self.project_text(x)
+
+        return x
 
-        # x.shape = [batch_size, n_ctx, transformer.width]
-        # take features from the eot embedding (eot_token is the highest number in each sequence)
-        x = x[torch.arange(x.shape[0]), text.argmax(dim=-1)] @ self.text_projection
+    def encode_text_suffixes(self, prefix, suffixes):
+        """
+        Encodes the sequences formed by one shared prefix followed by each row of `suffixes`, computing the
+        prefix's hidden states once; `prefix` has shape [prefix_length] and must not contain the eot token,
+        and `suffixes` has shape [batch_size, suffix_length] and holds the eot token of every sequence.
+        """
+        x = self.token_embedding(prefix[None]).type(self.dtype)  # [1, prefix_length, d_model]
+        x = x + self.positional_embedding[:len(prefix)].type(self.dtype)
+        prefix_kv = self.transformer.forward_prefix(x.permute(1, 0, 2))
+
+        x = self.token_embedding(suffixes).type(self.dtype)  # [batch_size, suffix_length, d_model]
+        x = x + self.positional_embedding[len(prefix):len(prefix) + suffixes.shape[1]].type(self.dtype)
+        x = x.permute(1, 0, 2)  # NLD -> LND
+        x = self.transformer.forward_query(x, suffixes.argmax(dim=-1), prefix_kv)
+        x = self.ln_final(x).type(self.dtype)
+        x = self.project_text(x)
 
         return x
 
+    def project_text(self, x):
+        """Applies text_projection to final hidden states"""
+        return self.text_projection_linear(x) if self.text_projection_linear is not None else x @ self.text_projection
+
     def forward(self, image, text):
         image_features = self.encode_image(image)
         text_features = self.encode_text(text)
@@ -383,34 +860,129 @@ class CLIP(nn.Module):
         return logits_per_image, logits_per_text
 
 
-def convert_weights(model: nn.Module):
-    """Convert applicable model parameters to fp16"""
+def convert_weights(model: nn.Module, dtype: torch.dtype = torch.float16, layer_norm: bool = False):
+    """Convert applicable model parameters to fp16, or to `dtype`; with `layer_norm`, LayerNorms are converted too and run natively in it"""
 
     def _convert_weights_to_fp16(l):
-        if isinstance(l, (nn.Conv1d, nn.Conv2d, nn.Linear)):
-            l.weight.data = l.weight.data.half()
+        if isinstance(l, (nn.Conv1d, nn.Conv2d, nn.Linear)) or (layer_norm and isinstance(l, LayerNorm)):
+            l.weight.data = l.weight.data.to(dtype)
             if l.bias is not None:
-                l.bias.data = l.bias.data.half()
+                l.bias.data = l.bias.data.to(dtype)
+            if isinstance(l, LayerNorm):
+                l.native = True
 
         if isinstance(l, nn.MultiheadAttention):
             for attr in [*[f"{s}_proj_weight" for s in ["in", "q", "k", "v"]], "in_proj_bias", "bias_k", "bias_v"]:
                 tensor = getattr(l, attr)
                 if tensor is not None:
-                    tensor.data = tensor.data.half()
+                    tensor.data = tensor.data.to(dtype)
 
         for name in ["text_projection", "proj"]:
             if hasattr(l, name):
                 attr = getattr(l, name)
                 if attr is not None:
-                    attr.data = attr.data.half()
+                    attr.data = attr.data.to(dtype)
 
     model.apply(_convert_weights_to_fp16)
 
 
-def build_model(state_dict: dict):
+# dtype: the dtype of the convolution, linear and projection weights, in which all activations are computed;
+# native_layer_norm: whether LayerNorms are converted to it too and normalize in it, rather than in fp32
+Precision = namedtuple("Precision", ["dtype", "native_layer_norm"])
+
+PRECISIONS = {
+    "fp32": Precision(torch.float32, True),
+    "fp16": Precision(torch.float16, False),  # fp16 statistics can overflow, so LayerNorm upcasts
+    "bf16": Precision(torch.bfloat16, True),  # bf16 has the range of fp32
+}
+
+
+def _linear(weight: torch.Tensor, bias: torch.Tensor = None) -> nn.Linear:
+    # constructed, then moved: the device and dtype arguments of nn.Linear need PyTorch 1.9
+    linear = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None).to(weight.device, weight.dtype)
+    with torch.no_grad():
+        linear.weight.copy_(weight)
+        if bias is not None:
+            linear.bias.copy_(bias)
+    return linear
+
+
+def quantize_int8(model: CLIP) -> CLIP:
+    """
+    Applies dynamic int8 quantization, for fp32 CPU inference, to the MLPs and the attention in/out projections of
+    the text and ViT transformers and to the text and ViT output projections; weights are stored as int8 and
+    activations quantized on the fly. The packed attention projections and the output projections are first
+    turned into nn.Linear stand-ins, so the attention always runs through `ResidualAttentionBlock.multi_head_attention`,
+    and the fp32 originals are dropped (`text_projection` and `visual.proj` become None).
+    The ResNet tower (convolutions and attention pooling) is left in fp32.
+    """
+    if model.dtype != torch.float32:
+        raise ValueError(f"Dynamic int8 quantization needs an fp32 model on CPU, got {model.dtype}")
+
+    for module in model.modules():
+        if isinstance(module, ResidualAttentionBlock):
+            module.in_proj_linear = _linear(module.attn.in_proj_weight, module.attn.in_proj_bias)
+            module.attn.in_proj_weight = module.attn.in_proj_bias = None
+            module.attn.out_proj = _linear(module.attn.out_proj.weight, module.attn.out_proj.bias)
+    names = set()
+    if model.transformer is not None:
+        model.text_projection_linear = _linear(model.text_projection.t())
+        model.text_projection = None
+        names |= {"transformer", "text_projection_linear"}
+    if isinstance(model.visual, VisionTransformer):
+        model.visual.proj_linear = _linear(model.visual.proj.t())
+        model.visual.proj = None
+        names |= {"visual.transformer", "visual.proj_linear"}
+
+    return quantize_dynamic(model, names, dtype=torch.qint8, inplace=True)
+
+
+def _supports_assign() -> bool:
+    """Whether load_state_dict can adopt the given tensors as parameters (PyTorch 2.1+), so build_model can skip initialization"""
+    return "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def _tower_keys(state_dict: dict, towers: str) -> List[str]:
+    """The keys of `state_dict` that a model built with `towers` has no parameter for"""
+    if towers == "both":
+        return []
+    if towers == "text":
+        return [k for k in state_dict if k.startswith("visual.")]
+    return [k for k in state_dict if not k.startswith("visual.") and k != "logit_scale"]
+
+
+def build_model(state_dict: dict, attention: str = "mha", precision: Union[str, Precision] = "fp16", towers: str = "both"):
+    """
+    Builds an eval-mode CLIP from a checkpoint's state dict, with the attention backend of `CLIP.set_attention_backend`
+    and a `precision` that is a key of PRECISIONS or a Precision; "fp32" loads the checkpoint straight into fp32
+    parameters without converting the model first.
+
+    With `towers="text"` or `"vision"`, only that tower is built, and the other tower's tensors are deleted from
+    `state_dict` itself before anything is converted, so callers that still need them should pass a copy;
+    `state_dict` then needs only the selected tower's keys (plus `logit_scale`).
+
+    On PyTorch 2.1+, the model is constructed on the meta device, without allocating or randomly initializing
+    weights, and adopts the checkpoint's tensors (cast to the precision's dtypes where they differ) as its
+    parameters: tensors already in the right dtype are shared with `state_dict` rather than copied, and the
+    others are replaced in `state_dict` by their cast copies.
+    """
+    if not isinstance(precision, Precision):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision!r}; available precisions = {list(PRECISIONS)}")
+        precision = PRECISIONS[precision]
+    if towers not in TOWERS:
+        raise ValueError(f"Unknown towers {towers!r}; available = {list(TOWERS)}")
+
+    for key in _tower_keys(state_dict, towers):
+        del state_dict[key]
+
     vit = "visual.proj" in state_dict
+    image_resolution = vision_layers = vision_width = vision_patch_size = None
+    context_length = vocab_size = transformer_width = transformer_heads = transformer_layers = None
 
-    if vit:
+    if towers == "text":
+        pass
+    elif vit:
         vision_width = state_dict["visual.conv1.weight"].shape[0]
         vision_layers = len([k for k in state_dict.keys() if k.startswith("visual.") and k.endswith(".attn.in_proj_weight")])
         vision_patch_size = state_dict["visual.conv1.weight"].shape[-1]
@@ -425,23 +997,41 @@ def build_model(state_dict: dict):
         assert output_width ** 2 + 1 == state_dict["visual.attnpool.positional_embedding"].shape[0]
         image_resolution = output_width * 32
 
-    embed_dim = state_dict["text_projection"].shape[1]
-    context_length = state_dict["positional_embedding"].shape[0]
-    vocab_size = state_dict["token_embedding.weight"].shape[0]
-    transformer_width = state_dict["ln_final.weight"].shape[0]
-    transformer_heads = transformer_width // 64
-    transformer_layers = len(set(k.split(".")[2] for k in state_dict if k.startswith(f"transformer.resblocks")))
-
-    model = CLIP(
-        embed_dim,
-        image_resolution, vision_layers, vision_width, vision_patch_size,
-        context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
-    )
+    if towers == "vision":
+        embed_dim = state_dict["visual.proj"].shape[1] if vit else state_dict["visual.attnpool.c_proj.weight"].shape[0]
+    else:
+        embed_dim = state_dict["text_projection"].shape[1]
+        context_length = state_dict["positional_embedding"].shape[0]
+        vocab_size = state_dict["token_embedding.weight"].shape[0]
+        transformer_width = state_dict["ln_final.weight"].shape[0]
+        transformer_heads = transformer_width // 64
+        transformer_layers = len(set(k.split(".")[2] for k in state_dict if k.startswith(f"transformer.resblocks")))
+
+    assign = _supports_assign()
+    with torch.device("meta") if assign else contextlib.nullcontext():
+        model = CLIP(
+            embed_dim,
+            image_resolution, vision_layers, vision_width, vision_patch_size,
+            context_length, vocab_size, transformer_width, transformer_heads, transformer_layers, towers
+        )
 
     for key in ["input_resolution", "context_length", "vocab_size"]:
         if key in state_dict:
             del state_dict[key]
 
-    convert_weights(model)
-    model.load_state_dict(state_dict)
+    if precision.dtype != torch.float32:
+        convert_weights(model, precision.dtype, layer_norm=precision.native_layer_norm)
+    if assign:
+        dtypes = {key: tensor.dtype for key, tensor in model.state_dict().items()}
+        for key, tensor in state_dict.items():  # in place, so that each original is freed once it's cast
+            state_dict[key] = tensor.to(dtypes.get(key, tensor.dtype))
+        model.load_state_dict(state_dict, assign=True)
+        # the only tensor that is neither a parameter nor a buffer, and so was left on the meta device
+        if model.transformer is not None:
+            attn_mask = model.build_attention_mask()
+            for block in model.transformer.resblocks:
+                block.attn_mask = attn_mask
+    else:
+        model.load_state_dict(state_dict)
+    model.set_attention_backend(attention)
     return model.eval()
@@ -0,0 +1,110 @@
+import inspect
+from collections import OrderedDict
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+__all__ = ["BatchTransform"]
+
+IMAGE_MEAN = (0.48145466, 0.4578275, 0.40821073)
+IMAGE_STD = (0.26862954, 0.26130258, 0.27577711)
+
+# antialiased resampling, which matches PIL's when downscaling, needs PyTorch 1.11
+_ANTIALIAS = "antialias" in inspect.signature(F.interpolate).parameters
+
+
+def _resized_size(height: int, width: int, n_px: int) -> Tuple[int, int]:
+    """The output size of torchvision's Resize(n_px): the shorter side becomes n_px and the longer one is truncated"""
+    if height <= width:
+        return n_px, int(n_px * width / height)
+    return int(n_px * height / width), n_px
+
+
+def _as_uint8(image: Union[Image.Image, torch.Tensor]) -> torch.Tensor:
+    if isinstance(image, Image.Image):
+        return torch.from_numpy(np.array(image.convert("RGB"))).permute(2, 0, 1)
+    if image.dtype != torch.uint8 or image.dim() != 3 or image.shape[0] != 3:
+        raise ValueError(f"Expected [3, H, W] uint8 image tensors, got {image.dtype} of shape {tuple(image.shape)}")
+    return image
+
+
+class BatchTransform(object):
+    """
+    The preprocessing of `clip.load`'s transform (bicubic resize of the shorter side to `n_px`, center crop, and
+    normalization), applied to whole batches of uint8 images at once: images of the same size are resized together
+    by antialiased `F.interpolate` on `device`, cropped as views, and converted and normalized with one fused
+    multiply-add into `dtype`. On the CPU the resampling runs in uint8 like PIL's; elsewhere it runs in two fp32
+    passes rounded to uint8 levels after each, like PIL's. Either way, more than 99% of the resized pixels equal the
+    PIL transform's and the rest are within two intensity levels. PIL images are converted to RGB before resizing, so
+    images with transparency resample their color channels without the alpha weighting of PIL's RGBA resize.
+
+    Before PyTorch 1.11, `F.interpolate` has no antialiasing, and images are resized by plain bicubic interpolation
+    in fp32 instead; that matches PIL when upscaling, but aliases when downscaling and no longer matches `preprocess`.
+    """
+
+    def __init__(self, n_px: int, device: Union[str, torch.device] = "cpu", dtype: torch.dtype = torch.float32,
+                 mean: Sequence[float] = IMAGE_MEAN, std: Sequence[float] = IMAGE_STD):
+        self.n_px = n_px
+        self.device = torch.device(device)
+        self.dtype = dtype
+        # (x / 255 - mean) / std as a single x * scale + shift
+        std = torch.tensor(std, dtype=torch.float32, device=self.device)
+        self.scale = (1 / (255 * std))[:, None, None]
+        self.shift = (-torch.tensor(mean, dtype=torch.float32, device=self.device) / std)[:, None, None]
+
+    def _resize(self, images: torch.Tensor) -> torch.Tensor:
+        size = _resized_size(images.shape[2], images.shape[3], self.n_px)
+        if not _ANTIALIAS:
+            resized = F.interpolate(images.float(), size=size, mode="bicubic", align_corners=False)
+            return resized.round_().clamp_(0, 255)
+        if images.device.type == "cpu":
+            # the uint8 kernel is about twice as fast on channels-last batches, but converting an NCHW batch costs more
+            try:
+                return F.interpolate(images, size=size, mode="bicubic", align_corners=False, antialias=True)
+            except RuntimeError:  # no uint8 kernel in this PyTorch version
+                pass
+        # like PIL, resample the width and then the height, rounding to uint8 levels after each pass
+        resized = images.float()
+        for pass_size in [(images.shape[2], size[1]), size]:
+            resized = F.interpolate(resized, size=pass_size, mode="bicubic", align_corners=False, antialias=True)
+            resized = resized.round_().clamp_(0, 255)
+        return resized
+
+    def _crop(self, images: torch.Tensor) -> torch.Tensor:
+        height, width = images.shape[2:]
+        top, left = int(round((height - self.n_px) / 2.0)), int(round((width - self.n_px) / 2.0))
+        return images[:, :, top:top + self.n_px, left:left + self.n_px]
+
+    def __call__(self, images: Union[torch.Tensor, List[Union[Image.Image, torch.Tensor]]]) -> torch.Tensor:
+        """
+        Preprocesses a [batch_size, 3, H, W] uint8 tensor, or a list of PIL images and [3, H, W] uint8 tensors of any
+        sizes, into a [batch_size, 3, n_px, n_px] tensor of `dtype` on `device`
+        """
+        if isinstance(images, torch.Tensor):
+            if images.dtype != torch.uint8 or images.dim() != 4 or images.shape[1] != 3:
+                raise ValueError(f"Expected a [batch_size, 3, H, W] uint8 tensor, got {images.dtype} of shape {tuple(images.shape)}")
+            groups = [(None, images)]
+        else:
+            images = [_as_uint8(image) for image in images]
+            sizes = OrderedDict()
+            for i, image in enumerate(images):
+                sizes.setdefault(tuple(image.shape[1:]), []).append(i)
+            # stacked as [batch_size, H, W, 3] and viewed as channels-last [batch_size, 3, H, W]
+            groups = [(rows, torch.stack([images[i].permute(1, 2, 0) for i in rows]).permute(0, 3, 1, 2)) for rows in sizes.values()]
+
+        batches = []
+        for rows, batch in groups:
+            # uint8 is a quarter of the bytes of the float batch, so it's moved before anything is computed
+            crops = self._crop(self._resize(batch.to(self.device, non_blocking=True)))
+            crops = crops.to(torch.float32, memory_format=torch.contiguous_format)
+            batches.append((rows, torch.addcmul(self.shift, crops, self.scale).to(self.dtype)))
+        if len(batches) == 1:
+            return batches[0][1]
+
+        output = torch.empty(len(images), 3, self.n_px, self.n_px, dtype=self.dtype, device=self.device)
+        for rows, batch in batches:
+            output[torch.tensor(rows, device=self.device)] = batch
+        return output
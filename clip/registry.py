@@ -0,0 +1,159 @@
+import inspect
+import threading
+import time
+import warnings
+from collections import OrderedDict, namedtuple
+from typing import Callable, Dict, Tuple, Union
+
+import torch
+
+from .clip import load
+
+__all__ = ["ModelRegistry"]
+
+RegistryInfo = namedtuple("RegistryInfo", ["hits", "misses", "evictions", "budget", "currbytes", "currsize"])
+
+# loads: times the model was loaded; hits: gets served by the resident instance; evictions: times it was evicted or unloaded;
+# load_seconds: duration of the most recent load; bytes: memory of its weights; resident: whether it is loaded now
+ModelStats = namedtuple("ModelStats", ["loads", "hits", "evictions", "load_seconds", "bytes", "resident"])
+
+
+def _storage(tensor: torch.Tensor) -> Tuple[int, int]:
+    """The address and size in bytes of the storage behind `tensor`"""
+    if hasattr(tensor, "untyped_storage"):
+        storage = tensor.untyped_storage()
+        return storage.data_ptr(), storage.nbytes()
+    storage = tensor.storage()  # PyTorch < 2.0
+    return storage.data_ptr(), storage.element_size() * storage.size()
+
+
+def model_bytes(model: torch.nn.Module) -> int:
+    """Memory of the tensors in `model`'s state dict, counting each storage once (packed quantized weights included)"""
+    seen, total = set(), 0
+    tensors = list(model.state_dict().values())
+    while tensors:
+        tensor = tensors.pop()
+        if isinstance(tensor, (tuple, list)):
+            tensors.extend(tensor)
+        elif isinstance(tensor, torch.Tensor) and not getattr(tensor, "is_meta", False):
+            address, size = _storage(tensor)
+            if address not in seen:
+                seen.add(address)
+                total += size
+    return total
+
+
+class ModelRegistry(object):
+    """
+    Shares the models returned by `clip.load` within a process: `get` loads a model once per (name, device, precision)
+    and the other `load` arguments, then returns the same instance to every caller, so the returned models must
+    not be modified. With `memory_budget` set (in bytes, over the weights of all resident models on every device),
+    the least recently used models are evicted once a load goes over it; an evicted model is only freed when
+    its callers drop it too, and is loaded again by the next `get`. Each model is loaded by one thread at a time,
+    without holding up `get`s of the other models.
+    """
+
+    def __init__(self, memory_budget: int = None, loader: Callable = load, **load_kwargs):
+        self.memory_budget = memory_budget
+        self.loader = loader
+        self.load_kwargs = load_kwargs
+        self.defaults = {k: p.default for k, p in inspect.signature(loader).parameters.items() if p.default is not p.empty}
+        self.models = OrderedDict()  # key -> (model, preprocess), least recently used first
+        self.sizes = {}
+        self.model_stats: Dict[tuple, ModelStats] = {}
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()  # guards the bookkeeping above, never held during a load
+        self.load_locks: Dict[tuple, threading.Lock] = {}  # held while the model of a key loads
+
+    def _key(self, name: str, device: Union[str, torch.device], precision: str, kwargs: dict) -> tuple:
+        device = torch.device(device)
+        if device.type == "cuda" and device.index is None:
+            device = torch.device("cuda", torch.cuda.current_device())
+        if precision is None:  # the default of `load`, so that it shares an entry with the explicit one
+            precision = "fp32" if device.type == "cpu" else "fp16"
+        # arguments left at the loader's defaults don't split entries either
+        kwargs = {k: v for k, v in {**self.load_kwargs, **kwargs}.items() if k not in self.defaults or v != self.defaults[k]}
+        return (name, str(device), precision, *sorted(kwargs.items()))
+
+    def _hit(self, key: tuple):
+        entry = self.models.get(key)
+        if entry is not None:
+            self.models.move_to_end(key)
+            self.hits += 1
+            self.model_stats[key] = self.model_stats[key]._replace(hits=self.model_stats[key].hits + 1)
+        return entry
+
+    def get(self, name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu",
+            precision: str = None, **kwargs) -> Tuple[torch.nn.Module, Callable]:
+        """Returns the shared `(model, preprocess)` of `clip.load(name, device, precision=precision, **kwargs)`"""
+        key = self._key(name, device, precision, kwargs)
+        with self.lock:
+            entry = self._hit(key)
+            if entry is not None:
+                return entry
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                entry = self._hit(key)  # loaded by another thread while this one waited
+                if entry is not None:
+                    return entry
+                self.misses += 1
+
+            start = time.perf_counter()
+            entry = self.loader(name, device=key[1], precision=key[2], **{**self.load_kwargs, **kwargs})
+            elapsed = time.perf_counter() - start
+            size = model_bytes(entry[0])
+
+            with self.lock:
+                self.models[key] = entry
+                self.sizes[key] = size
+                stats = self.model_stats.get(key, ModelStats(0, 0, 0, 0.0, 0, False))
+                self.model_stats[key] = stats._replace(loads=stats.loads + 1, load_seconds=elapsed, bytes=size, resident=True)
+                self._evict(keep=key)
+            return entry
+
+    def _evict(self, keep: tuple):
+        if self.memory_budget is None:
+            return
+        while sum(self.sizes.values()) > self.memory_budget and len(self.models) > 1:
+            self._remove(next(key for key in self.models if key != keep))
+            self.evictions += 1
+        if sum(self.sizes.values()) > self.memory_budget:
+            warnings.warn(f"{keep[0]} alone takes {self.sizes[keep] / 2 ** 20:.0f} MB, over the registry's memory budget")
+
+    def _remove(self, key: tuple):
+        model, _ = self.models.pop(key)
+        del self.sizes[key]
+        stats = self.model_stats[key]
+        self.model_stats[key] = stats._replace(evictions=stats.evictions + 1, resident=False)
+        if model.logit_scale.is_cuda:
+            del model
+            torch.cuda.empty_cache()
+
+    def unload(self, name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu",
+               precision: str = None, **kwargs) -> bool:
+        """Evicts the model `get` would return for these arguments, returning whether it was resident"""
+        key = self._key(name, device, precision, kwargs)
+        with self.lock:
+            if key not in self.models:
+                return False
+            self._remove(key)
+            return True
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.models):
+                self._remove(key)
+
+    def cache_info(self) -> RegistryInfo:
+        with self.lock:
+            return RegistryInfo(self.hits, self.misses, self.evictions, self.memory_budget, sum(self.sizes.values()), len(self.models))
+
+    def stats(self) -> Dict[tuple, ModelStats]:
+        """Per-model statistics, for every model loaded so far, keyed by (name, device, precision, *load arguments)"""
+        with self.lock:
+            return dict(self.model_stats)
+
+    def __len__(self) -> int:
+        return len(self.models)
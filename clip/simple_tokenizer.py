@@ -1,6 +1,10 @@
 import gzip
+import heapq
 import html
+import mmap
 import os
+import struct
+from collections import OrderedDict, namedtuple
 from functools import lru_cache
 
 import ftfy
@@ -35,6 +39,68 @@ def bytes_to_unicode():
     return dict(zip(bs, cs))
 
 
+COMPILED_BPE_MAGIC = b"CLIPBPE1"
+_COMPILED_BPE_HEADER = struct.Struct("<8sIII")  # magic, vocab size, number of merges, vocab blob size
+
+
+def _load_gzip_bpe(bpe_path: str):
+    merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
+    merges = merges[1:49152-256-2+1]
+    merges = [tuple(merge.split()) for merge in merges]
+    vocab = list(bytes_to_unicode().values())
+    vocab = vocab + [v+'</w>' for v in vocab]
+    for merge in merges:
+        vocab.append(''.join(merge))
+    vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+    return vocab, merges
+
+
+def _load_compiled_bpe(bpe_path: str):
+    with open(bpe_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        _, vocab_size, num_merges, blob_size = _COMPILED_BPE_HEADER.unpack_from(buffer)
+        offset = _COMPILED_BPE_HEADER.size
+        vocab = str(buffer[offset:offset + blob_size], "utf-8").split('\n')
+        offset += blob_size + (-blob_size % 4)
+        pair_ids = memoryview(buffer)[offset:offset + 8 * num_merges].cast("i")
+        try:
+            merges = list(zip(map(vocab.__getitem__, pair_ids[0::2]), map(vocab.__getitem__, pair_ids[1::2])))
+        finally:
+            pair_ids.release()
+    assert len(vocab) == vocab_size
+    return vocab, merges
+
+
+def load_bpe(bpe_path: str):
+    """Returns the vocabulary list and the ranked list of merge pairs from a gzipped or compiled BPE file"""
+    with open(bpe_path, "rb") as f:
+        magic = f.read(len(COMPILED_BPE_MAGIC))
+    if magic == COMPILED_BPE_MAGIC:
+        return _load_compiled_bpe(bpe_path)
+    return _load_gzip_bpe(bpe_path)
+
+
+def compile_bpe(bpe_path: str, output_path: str):
+    """
+    Writes the vocabulary and merge ranks of a BPE file in a binary form that `SimpleTokenizer` can
+    memory-map instead of decompressing and parsing the gzipped merges list:
+    a header, the newline-separated utf-8 vocabulary, and an int32 (left id, right id) pair per merge
+    """
+    vocab, merges = load_bpe(bpe_path)
+    encoder = dict(zip(vocab, range(len(vocab))))
+    blob = '\n'.join(vocab).encode("utf-8")
+    pair_ids = memoryview(bytearray(8 * len(merges))).cast("i")
+    for rank, (first, second) in enumerate(merges):
+        pair_ids[2 * rank] = encoder[first]
+        pair_ids[2 * rank + 1] = encoder[second]
+
+    with open(output_path + ".tmp", "wb") as f:
+        f.write(_COMPILED_BPE_HEADER.pack(COMPILED_BPE_MAGIC, len(vocab), len(merges), len(blob)))
+        f.write(blob)
+        f.write(bytes(-len(blob) % 4))
+        f.write(pair_ids.cast("B"))
+    os.replace(output_path + ".tmp", output_path)
+
+
 def get_pairs(word):
     """Return set of symbol pairs in a word.
     Word is represented as tuple of symbols (symbols being variable-length strings).
@@ -59,70 +125,132 @@ def whitespace_clean(text):
     return text
 
 
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str = default_bpe()):
+    def __init__(self, bpe_path: str = default_bpe(), cache_size: int = 2 ** 16, warm_cache: int = 0):
+        """
+        Parameters
+        ----------
+        bpe_path : str
+            Path to the gzipped BPE merges file, or to its compiled form written by `compile_bpe`
+
+        cache_size : int
+            Maximum number of tokens whose BPE result is kept, evicting the least recently used one
+            first; None keeps every token and 0 disables the cache
+
+        warm_cache : int
+            Pre-populate the cache with the whole-word tokens produced by the first `warm_cache`
+            merges, which are the most frequent ones in the BPE training data
+        """
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
-        merges = merges[1:49152-256-2+1]
-        merges = [tuple(merge.split()) for merge in merges]
-        vocab = list(bytes_to_unicode().values())
-        vocab = vocab + [v+'</w>' for v in vocab]
-        for merge in merges:
-            vocab.append(''.join(merge))
-        vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+        # utf-8 bytes decoded as latin-1 map one-to-one onto code points 0-255, so a single
+        # str.translate does the byte -> unicode mapping for a whole token
+        self.byte_table = str.maketrans({chr(b): c for b, c in self.byte_encoder.items()})
+        vocab, merges = load_bpe(bpe_path)
         self.encoder = dict(zip(vocab, range(len(vocab))))
-        self.decoder = {v: k for k, v in self.encoder.items()}
+        self.decoder = dict(enumerate(vocab))
         self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        self.special_tokens = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = self.cache_misses = self.cache_evictions = 0
         self.pat = re.compile(r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""", re.IGNORECASE)
 
+        if warm_cache:
+            self.warm_cache(merges[:warm_cache])
+
+    def warm_cache(self, merges):
+        """Run the whole-word tokens produced by the given merges through `bpe` so they are cached"""
+        for merge in merges:
+            if self.cache_size is not None and len(self.cache) >= self.cache_size:
+                break
+            symbol = ''.join(merge)
+            if symbol.endswith('</w>') and len(symbol) > len('</w>') + 1:
+                self.bpe(symbol[:-len('</w>')])
+        self.cache_hits = self.cache_misses = self.cache_evictions = 0
+
+    def cache_info(self):
+        """Report BPE cache statistics, in the style of functools.lru_cache"""
+        return CacheInfo(self.cache_hits, self.cache_misses, self.cache_evictions, self.cache_size, len(self.cache))
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.cache_hits = self.cache_misses = self.cache_evictions = 0
+
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token[:-1]) + ( token[-1] + '</w>',)
-        pairs = get_pairs(word)
+        if token in self.special_tokens:
+            return self.special_tokens[token]
+        if len(token) == 1:
+            return token + '</w>'
 
-        if not pairs:
-            return token+'</w>'
+        # the cache is shared by every thread using the tokenizer without a lock, so another thread may
+        # evict a token between two of these calls; that only costs its recency
+        word = self.cache.get(token)
+        if word is not None:
+            self.cache_hits += 1
+            try:
+                self.cache.move_to_end(token)
+            except KeyError:
+                pass
+            return word
+        self.cache_misses += 1
 
-        while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
+        symbols = list(token[:-1]) + [token[-1] + '</w>']
+
+        # symbols form a linked list; merging a pair folds the right node into the left one, so a
+        # node's index is also its position order. the heap holds (rank, left index) for every
+        # adjacent pair, and entries whose pair has since changed are discarded when popped.
+        ranks = self.bpe_ranks
+        prev = list(range(-1, len(symbols) - 1))
+        nxt = list(range(1, len(symbols) + 1))
+        nxt[-1] = -1
+        heap = []
+        for i in range(len(symbols) - 1):
+            rank = ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None:
+                heap.append((rank, i))
+        heapq.heapify(heap)
+
+        while heap:
+            rank, i = heapq.heappop(heap)
+            j = nxt[i]
+            if symbols[i] is None or j == -1 or ranks.get((symbols[i], symbols[j])) != rank:
+                continue
+
+            symbols[i] += symbols[j]
+            symbols[j] = None
+            nxt[i] = nxt[j]
+            if nxt[i] != -1:
+                prev[nxt[i]] = i
+
+            if prev[i] != -1:
+                rank = ranks.get((symbols[prev[i]], symbols[i]))
+                if rank is not None:
+                    heapq.heappush(heap, (rank, prev[i]))
+            if nxt[i] != -1:
+                rank = ranks.get((symbols[i], symbols[nxt[i]]))
+                if rank is not None:
+                    heapq.heappush(heap, (rank, i))
+
+        word = ' '.join(symbol for symbol in symbols if symbol is not None)
+        if self.cache_size is None or self.cache_size > 0:
+            self.cache[token] = word
+            if self.cache_size is not None and len(self.cache) > self.cache_size:
                 try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
+                    self.cache.popitem(last=False)
+                    self.cache_evictions += 1
+                except KeyError:  # emptied by another thread
+                    pass
         return word
 
     def encode(self, text):
         bpe_tokens = []
         text = whitespace_clean(basic_clean(text)).lower()
         for token in re.findall(self.pat, text):
-            token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
+            token = token.encode('utf-8').decode('latin-1').translate(self.byte_table)
             bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
         return bpe_tokens
 
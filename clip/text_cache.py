@@ -0,0 +1,170 @@
+import hashlib
+import os
+from collections import OrderedDict, namedtuple
+from typing import List, Union
+
+import numpy as np
+import torch
+
+from .clip import tokenize
+from .model import CLIP
+
+__all__ = ["TextFeatureCache"]
+
+TextCacheInfo = namedtuple("TextCacheInfo", ["hits", "disk_hits", "misses", "evictions", "maxsize", "currsize"])
+
+
+def _model_fingerprint(model: CLIP) -> str:
+    """Identifies the text tower by hashing the names, shapes and values of all its tensors together with the compute dtype"""
+    digest = hashlib.sha1(str(model.dtype).encode())
+    for name, tensor in model.state_dict().items():
+        if name.startswith("visual.") or name == "logit_scale":
+            continue
+        tensors = list(tensor) if isinstance(tensor, (tuple, list)) else [tensor]  # packed int8 weights are (weight, bias)
+        for tensor in tensors:
+            if not isinstance(tensor, torch.Tensor):
+                continue
+            tensor = tensor.detach()
+            tensor = (tensor.dequantize() if tensor.is_quantized else tensor).float().cpu()
+            digest.update(f"{name}{tuple(tensor.shape)}".encode())
+            digest.update(tensor.numpy().tobytes())
+    return digest.hexdigest()
+
+
+class _DiskTier:
+    """
+    Append-only store of fp16 feature rows in a memory-mapped file, next to a text index mapping token-id
+    digests to row numbers. Rows are flushed to disk before their index entries are written, and the row count
+    comes from the size of the features file, so an interrupted write leaves at most rows that no entry points
+    to. Only one process should write to a directory at a time.
+    """
+
+    def __init__(self, root: str, width: int):
+        os.makedirs(root, exist_ok=True)
+        self.width = width
+        self.row_bytes = width * np.dtype(np.float16).itemsize
+        self.features_path = os.path.join(root, "features.f16")
+        self.index_path = os.path.join(root, "index.txt")
+
+        size = os.path.getsize(self.features_path) if os.path.isfile(self.features_path) else 0
+        self.rows = size // self.row_bytes
+        if size != self.rows * self.row_bytes:  # a row cut short by an interrupted write
+            with open(self.features_path, "r+b") as f:
+                f.truncate(self.rows * self.row_bytes)
+
+        self.index = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r+b") as f:
+                data = f.read()
+                f.truncate(data.rfind(b"\n") + 1)  # drops a line cut short by an interrupted write
+            for line in data[:data.rfind(b"\n") + 1].decode().splitlines():
+                digest, row = line.split()
+                if int(row) < self.rows:  # an entry written before its row reached the disk by an older version
+                    self.index[digest] = int(row)
+        self.features = None
+
+    def _mapped(self):
+        if self.features is None or len(self.features) < self.rows:
+            self.features = np.memmap(self.features_path, dtype=np.float16, mode="r", shape=(self.rows, self.width))
+        return self.features
+
+    def get(self, digest: str):
+        row = self.index.get(digest)
+        if row is None:
+            return None
+        return torch.from_numpy(np.array(self._mapped()[row]))
+
+    def put(self, digests: List[str], features: torch.Tensor):
+        rows = features.detach().to("cpu", torch.float16).numpy()
+        with open(self.features_path, "ab") as f:
+            f.write(rows.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        entries = {digest: self.rows + i for i, digest in enumerate(digests)}
+        with open(self.index_path, "a") as f:
+            f.write("".join(f"{digest} {row}\n" for digest, row in entries.items()))
+        self.index.update(entries)
+        self.rows += len(rows)
+
+
+class TextFeatureCache(object):
+    """
+    An opt-in cache in front of `CLIP.encode_text`, so repeated prompts cost a lookup instead of a transformer pass.
+
+    Entries are keyed by the model's identity and the token ids up to the end-of-text token, so padded and trimmed
+    tokenizations of the same text share an entry; the model's identity is a digest of every text-tower tensor,
+    computed once when the cache is created. Recently used features are kept in memory up to `capacity`
+    rows; with `path` set, every encoded row is also written through to an on-disk fp16 tier under
+    `path/<model fingerprint>/` that survives restarts and can be shared by models with identical weights.
+    """
+
+    def __init__(self, model: CLIP, capacity: int = 65536, path: str = None):
+        self.model = model
+        self.capacity = capacity
+        self.model_key = _model_fingerprint(model)
+        self.memory = OrderedDict()
+        self.disk = _DiskTier(os.path.join(path, self.model_key), model.embed_dim) if path else None
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+    def cache_info(self) -> TextCacheInfo:
+        return TextCacheInfo(self.hits, self.disk_hits, self.misses, self.evictions, self.capacity, len(self.memory))
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / lookups if lookups else 0.0
+
+    def _remember(self, key: bytes, feature: torch.Tensor):
+        self.memory[key] = feature
+        if len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+            self.evictions += 1
+
+    def __call__(self, text: torch.LongTensor) -> torch.Tensor:
+        """Returns the same features as `model.encode_text(text)`, rows served from the disk tier being fp16-rounded"""
+        dtype, device = self.model.dtype, self.model.logit_scale.device
+        if len(text) == 0:
+            return torch.zeros(0, self.model.embed_dim, dtype=dtype, device=device)
+
+        lengths = text.argmax(dim=-1) + 1
+        rows = text.cpu().numpy()
+        keys = [rows[i, :length].tobytes() for i, length in enumerate(lengths.tolist())]
+
+        found = {}
+        missing = OrderedDict()  # unique missing keys -> index of the first row carrying them
+        for i, key in enumerate(keys):
+            if key in found or key in missing:
+                continue
+            feature = self.memory.get(key)
+            if feature is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                found[key] = feature
+                continue
+            if self.disk is not None:
+                feature = self.disk.get(hashlib.sha1(key).hexdigest())
+                if feature is not None:
+                    feature = feature.to(device=device, dtype=dtype)
+                    self.disk_hits += 1
+                    found[key] = feature
+                    self._remember(key, feature)
+                    continue
+            self.misses += 1
+            missing[key] = i
+
+        if missing:
+            index = torch.tensor(list(missing.values()), device=text.device)
+            batch = text[index, :int(lengths[index].max())].to(device)
+            with torch.no_grad():
+                features = self.model.encode_text(batch)
+            for key, feature in zip(missing, features):
+                feature = feature.clone()  # don't let a cached row keep the whole batch alive
+                found[key] = feature
+                self._remember(key, feature)
+            if self.disk is not None:
+                self.disk.put([hashlib.sha1(key).hexdigest() for key in missing], features)
+
+        return torch.stack([found[key] for key in keys])
+
+    def encode(self, texts: Union[str, List[str]]) -> torch.Tensor:
+        """Tokenizes and encodes raw strings through the cache"""
+        return self(tokenize(texts, trim=True))
@@ -0,0 +1,106 @@
+from typing import List, Tuple
+
+import torch
+
+from .clip import tokenize
+from .model import CLIP
+
+__all__ = ["build_zeroshot_head", "save_zeroshot_head", "load_zeroshot_head", "classify"]
+
+
+def build_zeroshot_head(model: CLIP, classnames: List[str], templates: List[str], batch_size: int = 256) -> torch.Tensor:
+    """
+    Builds zero-shot classifier weights by prompt ensembling
+
+    Parameters
+    ----------
+    model : CLIP
+        The model whose text tower encodes the prompts
+
+    classnames : List[str]
+        The class names, substituted for `{}` in each template
+
+    templates : List[str]
+        The prompt templates, such as "a photo of a {}."; see data/prompts.md for the ones used in the paper
+
+    batch_size : int
+        The number of prompts encoded at a time, which bounds the memory used regardless of the number of classes
+
+    Returns
+    -------
+    A float32 tensor of L2-normalized class embeddings on the model's device, shape = [len(classnames), embed_dim]
+    """
+    device = model.logit_scale.device
+    weights = torch.zeros(len(classnames), model.embed_dim, device=device)
+
+    with torch.no_grad():
+        for template in templates:
+            for start in range(0, len(classnames), batch_size):
+                texts = [template.format(c) for c in classnames[start:start + batch_size]]
+                # prompts built from one template only differ after the class slot, so the tokens before it are shared
+                features = model.encode_text(tokenize(texts, truncate=True, trim=True).to(device), share_prefix=True).float()
+                weights[start:start + len(texts)] += features / features.norm(dim=-1, keepdim=True)
+
+    return weights / weights.norm(dim=-1, keepdim=True)
+
+
+def save_zeroshot_head(path: str, weights: torch.Tensor, classnames: List[str] = None):
+    """Saves classifier weights from `build_zeroshot_head`, with their class names, for reuse"""
+    torch.save({"weights": weights.cpu(), "classnames": classnames}, path)
+
+
+def load_zeroshot_head(path: str, device: str = "cpu") -> Tuple[torch.Tensor, List[str]]:
+    """Loads classifier weights saved by `save_zeroshot_head`, returning the weights and the class names"""
+    head = torch.load(path, map_location=device)
+    return head["weights"], head["classnames"]
+
+
+def classify(model: CLIP, images: torch.Tensor, weights: torch.Tensor, topk: int = 5, chunk_size: int = 4096) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Scores images against zero-shot classifier weights, visiting the classes in chunks so that memory stays
+    bounded for label sets of any size
+
+    Parameters
+    ----------
+    model : CLIP
+        The model whose vision tower encodes the images
+
+    images : torch.Tensor
+        A batch of preprocessed images
+
+    weights : torch.Tensor
+        Classifier weights from `build_zeroshot_head`, shape = [num_classes, embed_dim]
+
+    topk : int
+        The number of top classes to return per image
+
+    chunk_size : int
+        The number of classes scored at a time
+
+    Returns
+    -------
+    probs : torch.Tensor
+        The softmax probabilities over all classes of the top-k classes, shape = [batch_size, topk]
+
+    indices : torch.Tensor
+        The indices of the top-k classes, shape = [batch_size, topk]
+    """
+    with torch.no_grad():
+        image_features = model.encode_image(images).float()
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        logit_scale = model.logit_scale.exp().float()
+
+        values = image_features.new_empty(len(images), 0)
+        indices = torch.empty(len(images), 0, dtype=torch.long, device=image_features.device)
+        log_normalizer = image_features.new_full((len(images),), float("-inf"))
+        for start in range(0, len(weights), chunk_size):
+            chunk = weights[start:start + chunk_size].to(image_features)
+            logits = logit_scale * image_features @ chunk.t()
+            log_normalizer = torch.logaddexp(log_normalizer, logits.logsumexp(dim=-1))
+
+            values = torch.cat([values, logits], dim=-1)
+            indices = torch.cat([indices, torch.arange(start, start + len(chunk), device=indices.device).expand(len(images), -1)], dim=-1)
+            values, order = values.topk(min(topk, values.shape[-1]), dim=-1)
+            indices = indices.gather(-1, order)
+
+    return (values - log_normalizer[:, None]).exp(), indices
@@ -17,5 +17,5 @@ setup(
         )
     ],
     include_package_data=True,
-    extras_require={'dev': ['pytest']},
+    extras_require={'dev': ['pytest'], 'onnx': ['onnx', 'onnxruntime']},
 )
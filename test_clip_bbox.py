@@ -227,7 +227,7 @@ import torch.nn.functional as F
 
 def img_fts_to_heatmap(img_fts, txt_fts):
     """
-    img_fts: list of image features with no global avg pooling layer, shape=(img_dim x img_dim, batch_size, features)
+    img_fts: dense image features from encode_image_dense, shape=(batch_size, grid_h, grid_w, features)
     Return: list of heatmaps
     """
 
@@ -239,7 +239,7 @@ def img_fts_to_heatmap(img_fts, txt_fts):
     print(batch_size)
     #img_dim = int(math.sqrt(img_fts.size()[0]))
     #img_norm = F.interpolate(img_norm.permute(2,1,0), size=int(input_resolution[0]*input_resolution[1]/64), mode='nearest').permute(2,1,0)
-    img_reshape = torch.reshape(img_norm, (22, 40, batch_size, img_fts.size()[2]))
+    img_reshape = img_norm.permute(1, 2, 0, 3)  # (grid_h, grid_w, batch_size, features)
     print(img_reshape.shape)
     print(txt_norm.shape)
     
@@ -516,6 +516,7 @@ frame_dict = json.load(f)
 seg_list = list(frame_dict.keys())[json_start_idx : json_end_idx]
 
 result_dict = {}
+tokenizer = SimpleTokenizer()
 
 for seg in seg_list:
     result_dict[seg] = frame_dict[seg]
@@ -561,7 +562,6 @@ for seg in seg_list:
             image_input -= image_mean[:, None, None]
             image_input /= image_std[:, None, None]
 
-            tokenizer = SimpleTokenizer()
             text_tokens = [tokenizer.encode(desc) for desc in cls_list]
 
             text_input = torch.zeros(len(text_tokens), model_modded.context_length, dtype=torch.long)
@@ -575,12 +575,11 @@ for seg in seg_list:
             text_input = text_input.cuda()
 
             with torch.no_grad():
-                image_features = model_modded.encode_image(image_input).float()
+                _, img_fts = model_modded.encode_image_dense(image_input)
+                img_fts = img_fts.float()
                 text_features = model_modded.encode_text(text_input).float()
 
             # get bbox results
-            img_fts = image_features[1:]
-
             heatmap_list = img_fts_to_heatmap(img_fts, text_features)
             pred_bboxes = []
             for h in range(len(heatmap_list)):
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from clip.model import CLIP
+
+
+def tiny_clip(vision: str = "vit", seed: int = 0) -> CLIP:
+    """A randomly initialized CLIP with the real tokenizer's vocabulary and context length but small towers"""
+    torch.manual_seed(seed)
+    if vision == "vit":
+        vision_kwargs = dict(image_resolution=32, vision_layers=2, vision_width=64, vision_patch_size=8)
+    else:
+        vision_kwargs = dict(image_resolution=64, vision_layers=(1, 1, 1, 1), vision_width=16, vision_patch_size=None)
+    model = CLIP(
+        embed_dim=32, **vision_kwargs,
+        context_length=77, vocab_size=49408, transformer_width=64, transformer_heads=4, transformer_layers=3,
+    )
+    return model.eval()
+
+
+@pytest.fixture(scope="module")
+def vit_model():
+    return tiny_clip("vit")
+
+
+@pytest.fixture(scope="module")
+def resnet_model():
+    return tiny_clip("resnet")
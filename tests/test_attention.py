@@ -0,0 +1,60 @@
+import pytest
+import torch
+
+from clip import tokenize
+from clip.model import build_model
+from tests.conftest import tiny_clip
+
+TEXTS = ["a photo of a cat.", "a photo of a dog.", "a photo of a large truck parked outside."]
+
+
+def _features(model):
+    torch.manual_seed(0)
+    resolution = model.visual.input_resolution
+    images = torch.randn(2, 3, resolution, resolution)
+    wide_images = torch.randn(2, 3, resolution, 2 * resolution)
+    text = tokenize(TEXTS, trim=True)
+    with torch.no_grad():
+        return [
+            model.encode_image(images),
+            *model.encode_image_dense(wide_images),
+            model.encode_text(text),
+            model.encode_text(text, share_prefix=True),
+        ]
+
+
+@pytest.mark.parametrize("vision", ["vit", "resnet"])
+def test_sdpa_backend_matches_mha(vision):
+    model = tiny_clip(vision)
+    expected = _features(model)
+    actual = _features(model.set_attention_backend("sdpa"))
+    for a, e in zip(actual, expected):
+        assert torch.allclose(a, e, atol=1e-5)
+
+
+def test_build_model_packs_attnpool_projections():
+    state_dict = tiny_clip("resnet").state_dict()
+    model = build_model(dict(state_dict), attention="sdpa").float()
+    attnpool = model.visual.attnpool
+    assert attnpool.attention_backend == "sdpa"
+    assert torch.equal(attnpool.in_proj_weight[:len(attnpool.q_proj.weight)], attnpool.q_proj.weight)
+    assert "visual.attnpool.in_proj_weight" not in model.state_dict()
+
+    model.set_attention_backend("mha")
+    assert attnpool.in_proj_weight is None
+
+    with pytest.raises(ValueError):
+        model.set_attention_backend("flash")
+
+
+def test_attention_mask_is_converted_once_per_dtype(vit_model):
+    block = vit_model.transformer.resblocks[0]
+    mask = block.attn_mask
+    with torch.no_grad():
+        vit_model.encode_text(tokenize(TEXTS))
+        vit_model.encode_text(tokenize(TEXTS, trim=True))
+
+    assert block.attn_mask is mask
+    assert list(block._attn_mask_cache) == [(torch.float32, torch.device("cpu"))]
+    assert block.mask(torch.float16, "cpu").dtype == torch.float16
+    assert len(block._attn_mask_cache) == 2
@@ -0,0 +1,67 @@
+import pytest
+import torch
+
+import clip
+import clip.model
+from clip.model import build_model
+from tests.conftest import tiny_clip
+
+
+@pytest.mark.parametrize("vision", ["vit", "resnet"])
+@pytest.mark.parametrize("precision", ["fp32", "fp16"])
+def test_meta_construction_matches_initialize_then_load(vision, precision, monkeypatch):
+    state_dict = tiny_clip(vision).state_dict()
+    model = build_model(dict(state_dict), precision=precision)
+    with monkeypatch.context() as m:
+        m.setattr(clip.model, "_supports_assign", lambda: False)
+        reference = build_model(dict(state_dict), precision=precision)
+
+    tensors = [*model.parameters(), *model.buffers(), model.transformer.resblocks[0].attn_mask]
+    assert not any(t.is_meta for t in tensors)
+    assert {k: (v.dtype, v.shape) for k, v in model.state_dict().items()} == \
+           {k: (v.dtype, v.shape) for k, v in reference.state_dict().items()}
+
+    model.float(), reference.float()
+    images = torch.randn(2, 3, model.visual.input_resolution, model.visual.input_resolution)
+    text = clip.tokenize(["a diagram", "a photo of a dog"])
+    with torch.no_grad():
+        assert torch.equal(model.encode_image(images), reference.encode_image(images))
+        assert torch.equal(model.encode_text(text), reference.encode_text(text))
+
+
+@pytest.mark.skipif(not clip.model._supports_assign(), reason="needs load_state_dict(assign=True)")
+def test_fp32_parameters_share_the_checkpoint_tensors():
+    state_dict = tiny_clip("vit").state_dict()
+    model = build_model(dict(state_dict), precision="fp32")
+    assert model.token_embedding.weight.data_ptr() == state_dict["token_embedding.weight"].data_ptr()
+
+
+@pytest.mark.parametrize("vision", ["vit", "resnet"])
+@pytest.mark.parametrize("precision", ["fp32", "fp16"])
+def test_single_tower_models_match_the_full_model(vision, precision):
+    state_dict = tiny_clip(vision).state_dict()
+    full = build_model(dict(state_dict), precision=precision)
+    text = build_model(dict(state_dict), precision=precision, towers="text")
+    visual = build_model({k: v for k, v in state_dict.items() if k.startswith("visual.") or k == "logit_scale"}, precision=precision, towers="vision")
+
+    assert text.visual is None and not any(k.startswith("visual.") for k in text.state_dict())
+    assert visual.transformer is None and all(k.startswith("visual.") or k == "logit_scale" for k in visual.state_dict())
+    assert text.dtype == visual.dtype == full.dtype
+
+    images = torch.randn(2, 3, full.visual.input_resolution, full.visual.input_resolution)
+    tokens = clip.tokenize(["a diagram", "a photo of a dog"], trim=True)
+    with torch.no_grad():
+        assert torch.equal(visual.encode_image(images), full.encode_image(images))
+        assert torch.equal(text.encode_text(tokens), full.encode_text(tokens))
+    with pytest.raises(RuntimeError, match="without the vision tower"):
+        text.encode_image(images)
+    with pytest.raises(RuntimeError, match="without the text tower"):
+        visual.encode_text(tokens)
+
+
+def test_single_tower_quantization():
+    state_dict = tiny_clip("vit").state_dict()
+    tokens = clip.tokenize(["a diagram"])
+    with torch.no_grad():
+        clip.model.quantize_int8(build_model(dict(state_dict), precision="fp32", towers="text")).encode_text(tokens)
+        clip.model.quantize_int8(build_model(dict(state_dict), precision="fp32", towers="vision")).encode_image(torch.randn(1, 3, 32, 32))
@@ -0,0 +1,114 @@
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+
+import clip.clip
+from clip.clip import _download
+
+PAYLOAD = os.urandom(300_000)
+SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get("Range"))
+        start = 0
+        if server.support_range and self.headers.get("Range"):
+            start = int(self.headers["Range"][len("bytes="):].rstrip("-"))
+            if start >= len(server.payload):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(server.payload) - 1}/{len(server.payload)}")
+        else:
+            self.send_response(200)
+        body = server.payload[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        server.bytes_sent += len(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.payload, httpd.support_range, httpd.requests, httpd.bytes_sent = PAYLOAD, True, [], 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def url(server, sha256=SHA256):
+    return f"http://127.0.0.1:{server.server_address[1]}/{sha256}/model.pt"
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_download_and_cached_hit_skips_hashing(server, tmp_path, monkeypatch):
+    path = _download(url(server), str(tmp_path))
+    assert read(path) == PAYLOAD
+    assert sorted(os.listdir(tmp_path)) == ["model.pt", "model.pt.verified"]
+
+    def fail(*args, **kwargs):
+        raise AssertionError("a verified file should not be hashed again")
+
+    monkeypatch.setattr(clip.clip, "_sha256", fail)
+    assert _download(url(server), str(tmp_path)) == path
+    assert len(server.requests) == 1
+
+
+def test_changed_file_is_rehashed_and_redownloaded(server, tmp_path):
+    path = _download(url(server), str(tmp_path))
+    with open(path, "r+b") as f:
+        f.write(b"corrupted")
+
+    with pytest.warns(UserWarning, match="checksum does not match"):
+        assert _download(url(server), str(tmp_path)) == path
+    assert read(path) == PAYLOAD
+    assert len(server.requests) == 2
+
+
+def test_resumes_partial_download(server, tmp_path):
+    with open(tmp_path / "model.pt.part", "wb") as f:
+        f.write(PAYLOAD[:100_000])
+
+    assert read(_download(url(server), str(tmp_path))) == PAYLOAD
+    assert server.requests == ["bytes=100000-"]
+    assert server.bytes_sent == len(PAYLOAD) - 100_000
+    assert not os.path.exists(tmp_path / "model.pt.part")
+
+
+def test_complete_partial_download_is_finished_without_transfer(server, tmp_path):
+    with open(tmp_path / "model.pt.part", "wb") as f:
+        f.write(PAYLOAD)
+
+    assert read(_download(url(server), str(tmp_path))) == PAYLOAD
+    assert server.bytes_sent == 0
+
+
+def test_restarts_when_server_ignores_range(server, tmp_path):
+    server.support_range = False
+    with open(tmp_path / "model.pt.part", "wb") as f:
+        f.write(b"stale bytes from another file")
+
+    assert read(_download(url(server), str(tmp_path))) == PAYLOAD
+    assert server.bytes_sent == len(PAYLOAD)
+
+
+def test_checksum_mismatch_leaves_no_file(server, tmp_path):
+    with pytest.raises(RuntimeError, match="SHA256 checksum"):
+        _download(url(server, sha256="0" * 64), str(tmp_path))
+    assert os.listdir(tmp_path) == []
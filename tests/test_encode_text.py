@@ -0,0 +1,54 @@
+import torch
+
+import clip
+from benchmarks.reference import reference_encode_text
+
+
+PROMPTS = ["a photo of a dog", "a diagram", "a very long and detailed description of a cat sitting on a mat in the sun"]
+
+
+def test_tokenize_trim_and_lengths():
+    padded = clip.tokenize(PROMPTS)
+    trimmed, lengths = clip.tokenize(PROMPTS, trim=True, return_lengths=True)
+
+    assert trimmed.shape == (len(PROMPTS), int(lengths.max()))
+    assert torch.equal(lengths, (padded != 0).sum(dim=-1))
+    assert torch.equal(trimmed, padded[:, :trimmed.shape[1]])
+
+
+def test_encode_text_trimmed_matches_padded(vit_model):
+    with torch.no_grad():
+        padded = vit_model.encode_text(clip.tokenize(PROMPTS))
+        trimmed = vit_model.encode_text(clip.tokenize(PROMPTS, trim=True))
+    assert torch.allclose(padded, trimmed, atol=1e-5)
+
+
+def test_encode_text_shared_prefix_matches(vit_model):
+    templated = clip.tokenize([f"a photo of a {c}." for c in ["dog", "cat", "golden retriever", "hot air balloon"]])
+    unrelated = clip.tokenize(PROMPTS)
+    with torch.no_grad():
+        for text in [templated, unrelated, templated[:1]]:
+            assert torch.allclose(vit_model.encode_text(text, share_prefix=True), vit_model.encode_text(text), atol=1e-5)
+
+
+def test_prefix_is_projected_once_per_block(vit_model, monkeypatch):
+    calls = []
+    for i, block in enumerate(vit_model.transformer.resblocks):
+        for name, owner, attribute in [("in_projection", block, "in_projection"), ("mlp", block.mlp, "forward")]:
+            def record(x, i=i, name=name, function=getattr(owner, attribute)):
+                calls.append((i, name))
+                return function(x)
+            monkeypatch.setattr(owner, attribute, record)
+
+    prefix = clip.tokenize("a photo of a")[0, :5]
+    with torch.no_grad():
+        vit_model.transformer.forward_prefix(vit_model.token_embedding(prefix[:, None]))
+    assert calls == [(0, "in_projection"), (0, "mlp"), (1, "in_projection"), (1, "mlp"), (2, "in_projection")]
+
+
+def test_encode_text_matches_full_computation(vit_model):
+    text = clip.tokenize(PROMPTS)
+    with torch.no_grad():
+        expected = reference_encode_text(vit_model, text)
+        assert torch.allclose(vit_model.encode_text(text), expected, atol=1e-5)
+        assert torch.allclose(vit_model.encode_text(text, share_prefix=True), expected, atol=1e-5)
@@ -0,0 +1,67 @@
+import pytest
+import torch
+
+import clip
+from clip.export import export_model, load_exported
+from clip.model import build_model
+from tests.conftest import tiny_clip
+
+TEXTS = ["a diagram", "a dog", "a photo of a cat sitting on a wooden table.", "a", "an aerial photo of a coastline."]
+
+
+@pytest.mark.parametrize("format", ["torchscript", "onnx"])
+@pytest.mark.parametrize("vision", ["vit", "resnet"])
+def test_exported_graphs_match_eager_model(vision, format, request, tmp_path):
+    if format == "onnx":
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+    model = request.getfixturevalue(f"{vision}_model")
+    paths = export_model(model, str(tmp_path), format=format)
+    assert sorted(paths) == ["image", "metadata", "text"]
+
+    encode_image, encode_text, metadata = load_exported(str(tmp_path))
+    assert metadata["input_resolution"] == model.visual.input_resolution
+    resolution = metadata["input_resolution"]
+
+    # batch sizes and text lengths other than those traced with
+    for images, text in [(torch.randn(1, 3, resolution, resolution), clip.tokenize(TEXTS, trim=True)),
+                         (torch.randn(5, 3, resolution, resolution), clip.tokenize(TEXTS[:2]))]:
+        with torch.no_grad():
+            assert torch.allclose(encode_image(images), model.encode_image(images), atol=1e-5)
+            assert torch.allclose(encode_text(text), model.encode_text(text), atol=1e-5)
+
+    assert model.transformer.resblocks[0].attention_backend == "mha"
+
+
+@pytest.mark.parametrize("format", ["torchscript", "onnx"])
+@pytest.mark.parametrize("towers", ["text", "vision"])
+def test_single_tower_export(towers, format, tmp_path):
+    if format == "onnx":
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+    model = build_model(tiny_clip("vit").state_dict(), precision="fp32", towers=towers)
+    paths = export_model(model, str(tmp_path), format=format)
+    assert sorted(paths) == sorted(["metadata", "text" if towers == "text" else "image"])
+
+    encode_image, encode_text, metadata = load_exported(str(tmp_path))
+    assert metadata["towers"] == towers and metadata["embed_dim"] == 32
+    with torch.no_grad():
+        if towers == "text":
+            assert encode_image is None
+            text = clip.tokenize(TEXTS)
+            assert torch.allclose(encode_text(text), model.encode_text(text), atol=1e-5)
+        else:
+            assert encode_text is None
+            images = torch.randn(3, 3, 32, 32)
+            assert torch.allclose(encode_image(images), model.encode_image(images), atol=1e-5)
+
+
+def test_unknown_export_format(vit_model, tmp_path):
+    with pytest.raises(ValueError):
+        export_model(vit_model, str(tmp_path), format="tflite")
+
+
+def test_onnx_export_needs_sdpa(vit_model, tmp_path, monkeypatch):
+    monkeypatch.delattr(torch.nn.functional, "scaled_dot_product_attention", raising=False)
+    with pytest.raises(RuntimeError, match="PyTorch 2.0"):
+        export_model(vit_model, str(tmp_path), format="onnx")
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+import torch
+
+import clip
+import clip.clip
+from tests.conftest import tiny_clip
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    path = str(tmp_path / "tiny.pt")
+    torch.save({k: v.half() if v.is_floating_point() else v for k, v in tiny_clip("vit").state_dict().items()}, path)
+    return path
+
+
+def _features(model):
+    torch.manual_seed(0)
+    images = torch.randn(2, 3, 32, 32)
+    text = clip.tokenize(["a diagram", "a photo of a dog on a couch."], trim=True)
+    with torch.no_grad():
+        return model.encode_image(images), model.encode_text(text)
+
+
+@pytest.mark.parametrize("precision", ["fp32", "fp16"])
+def test_warm_load_uses_converted_checkpoint(checkpoint, tmp_path, precision, monkeypatch):
+    cold, _ = clip.load(checkpoint, device="cpu", download_root=str(tmp_path), cache=True, precision=precision)
+    converted = clip.clip._converted_path(checkpoint, str(tmp_path), precision)
+    assert os.path.isfile(converted)
+
+    with monkeypatch.context() as m:
+        def fail(*args, **kwargs):
+            raise AssertionError("a warm load should not read the original checkpoint")
+
+        m.setattr(torch.jit, "load", fail)
+        m.setattr(clip.clip, "_save_converted", fail)
+        warm, _ = clip.load(checkpoint, device="cpu", download_root=str(tmp_path), cache=True, precision=precision)
+
+    assert {k: v.dtype for k, v in warm.state_dict().items()} == {k: v.dtype for k, v in cold.state_dict().items()}
+    for w, c in zip(_features(warm), _features(cold)):
+        assert torch.equal(w, c)
+
+
+def test_changed_checkpoint_is_converted_again(checkpoint, tmp_path):
+    clip.load(checkpoint, device="cpu", download_root=str(tmp_path), cache=True)
+    torch.save({k: v.half() if v.is_floating_point() else v for k, v in tiny_clip("vit", seed=1).state_dict().items()}, checkpoint)
+
+    model, _ = clip.load(checkpoint, device="cpu", download_root=str(tmp_path), cache=True)
+    reference, _ = clip.load(checkpoint, device="cpu", download_root=str(tmp_path))
+    for m, r in zip(_features(model), _features(reference)):
+        assert torch.equal(m, r)
+    assert len(os.listdir(tmp_path / "converted")) == 2
+
+
+def test_unreadable_converted_checkpoint_is_rebuilt(checkpoint, tmp_path):
+    converted = clip.clip._converted_path(checkpoint, str(tmp_path), "fp32")
+    os.makedirs(os.path.dirname(converted))
+    with open(converted, "wb") as f:
+        f.write(b"not a checkpoint")
+
+    with pytest.warns(UserWarning, match="Could not read"):
+        clip.load(checkpoint, device="cpu", download_root=str(tmp_path), cache=True)
+    assert clip.clip._load_converted(converted) is not None
+
+
+def test_cache_disabled_by_default(checkpoint, tmp_path):
+    clip.load(checkpoint, device="cpu", download_root=str(tmp_path))
+    assert not os.path.exists(tmp_path / "converted")
+
+
+def test_unwritable_cache_only_warns(checkpoint, tmp_path):
+    (tmp_path / "notadir").write_text("")
+    with pytest.warns(UserWarning, match="Could not write"):
+        model, _ = clip.load(checkpoint, device="cpu", download_root=str(tmp_path / "notadir" / "sub"), cache=True)
+    assert model.visual is not None
+
+
+def test_text_tower_load_caches_only_the_text_tower(checkpoint, tmp_path):
+    model, preprocess = clip.load(checkpoint, device="cpu", download_root=str(tmp_path), cache=True, towers="text")
+    assert model.visual is None and preprocess is None
+
+    converted = clip.clip._load_converted(clip.clip._converted_path(checkpoint, str(tmp_path), "fp32", "text"))
+    assert converted.keys() == model.state_dict().keys()
+    warm, _ = clip.load(checkpoint, device="cpu", download_root=str(tmp_path), cache=True, towers="text")
+    full, _ = clip.load(checkpoint, device="cpu")
+    text = clip.tokenize(["a diagram", "a photo of a dog on a couch."], trim=True)
+    with torch.no_grad():
+        assert torch.equal(warm.encode_text(text), full.encode_text(text))
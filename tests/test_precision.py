@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+import clip
+import clip.model
+from clip.model import PRECISIONS, Precision, build_model
+from tests.conftest import tiny_clip
+
+
+@pytest.fixture(scope="module")
+def state_dict():
+    return tiny_clip("vit").state_dict()
+
+
+def _features(model):
+    torch.manual_seed(0)
+    images = torch.randn(2, 3, 32, 32)
+    text = clip.tokenize(["a diagram", "a photo of a dog on a couch."], trim=True)
+    with torch.no_grad():
+        return model.encode_image(images).float(), model.encode_text(text).float()
+
+
+def test_fp32_skips_conversion(state_dict, monkeypatch):
+    monkeypatch.setattr(clip.model, "convert_weights", lambda *args, **kwargs: pytest.fail("converted an fp32 model"))
+    model = build_model(dict(state_dict), precision="fp32")
+    assert {p.dtype for p in model.parameters()} == {torch.float32}
+
+
+@pytest.mark.parametrize("precision", ["fp16", "bf16", Precision(torch.bfloat16, False)])
+def test_low_precision_policies(state_dict, precision):
+    expected = _features(build_model(dict(state_dict), precision="fp32"))
+    model = build_model(dict(state_dict), precision=precision)
+    policy = PRECISIONS.get(precision, precision)
+
+    assert model.dtype == policy.dtype
+    assert model.transformer.resblocks[0].mlp.c_fc.weight.dtype == policy.dtype
+    assert model.ln_final.native == policy.native_layer_norm
+    assert model.ln_final.weight.dtype == (policy.dtype if policy.native_layer_norm else torch.float32)
+    for actual, e in zip(_features(model), expected):
+        assert torch.nn.functional.cosine_similarity(actual, e).min() > 0.99
+
+
+def test_unknown_precision(state_dict):
+    with pytest.raises(ValueError):
+        build_model(dict(state_dict), precision="fp8")
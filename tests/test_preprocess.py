@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+import clip.preprocess
+from clip import BatchTransform
+from clip.clip import _transform
+
+# two intensity levels over the smallest std
+TOLERANCE = 2 / (255 * min(clip.preprocess.IMAGE_STD)) + 1e-4
+
+
+@pytest.fixture(scope="module")
+def images():
+    rng = np.random.default_rng(0)
+    sizes = [(480, 640), (300, 200), (480, 640), (224, 224), (225, 301), (97, 500)]
+    return [Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8)) for h, w in sizes] + [Image.open("CLIP.png").convert("RGB")]
+
+
+needs_antialias = pytest.mark.skipif(not clip.preprocess._ANTIALIAS, reason="needs antialiased F.interpolate (PyTorch 1.11)")
+
+
+@needs_antialias
+@pytest.mark.parametrize("n_px", [224, 64])
+def test_matches_pil_transform(images, n_px):
+    expected = torch.stack([_transform(n_px)(image) for image in images])
+    output = BatchTransform(n_px)(images)
+    assert output.shape == expected.shape and output.is_contiguous()
+    assert (output - expected).abs().max() <= TOLERANCE
+
+
+def test_tensor_batch_matches_image_list(images):
+    same_size = [images[0], images[2]]
+    batch = torch.stack([torch.from_numpy(np.array(image)).permute(2, 0, 1) for image in same_size])
+    transform = BatchTransform(224, dtype=torch.float16)
+    output = transform(batch)
+    assert output.dtype == torch.float16
+    assert torch.equal(output, transform(same_size))
+    assert torch.equal(output, transform(list(batch)))
+
+
+@needs_antialias
+def test_float_resampling_fallback(images, monkeypatch):
+    interpolate = clip.preprocess.F.interpolate
+
+    def float_only(x, *args, **kwargs):
+        if x.dtype == torch.uint8:
+            raise RuntimeError("no uint8 kernel")
+        return interpolate(x, *args, **kwargs)
+
+    monkeypatch.setattr(clip.preprocess.F, "interpolate", float_only)
+    expected = torch.stack([_transform(224)(image) for image in images])
+    assert (BatchTransform(224)(images) - expected).abs().max() <= TOLERANCE
+
+
+def test_rejects_non_uint8_tensors():
+    with pytest.raises(ValueError, match="uint8"):
+        BatchTransform(224)(torch.rand(2, 3, 32, 32))
+    with pytest.raises(ValueError, match="uint8"):
+        BatchTransform(224)([torch.zeros(32, 32, 3, dtype=torch.uint8)])
+
+
+def test_resizes_without_antialiasing_on_older_pytorch(images, monkeypatch):
+    monkeypatch.setattr(clip.preprocess, "_ANTIALIAS", False)
+    expected = _transform(224)(images[-1])[None]  # downscaling noise aliases, so only the photo-like CLIP.png
+    output = BatchTransform(224)(images[-1:])
+    assert output.shape == expected.shape
+    assert (output - expected).abs().mean() < 0.1
@@ -0,0 +1,53 @@
+import copy
+
+import pytest
+import torch
+from PIL import Image
+
+import clip
+from clip.clip import _transform
+from clip.model import quantize_int8
+from tests.conftest import tiny_clip
+
+try:
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+except ImportError:  # PyTorch < 1.13
+    from torch.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+TEXTS = ["a diagram", "a dog", "a cat", "a photo of a dog sleeping on a couch in the afternoon sun."]
+
+
+@pytest.mark.parametrize("vision", ["vit", "resnet"])
+def test_int8_embeddings_stay_close_to_fp32(vision):
+    model = tiny_clip(vision)
+    quantized = quantize_int8(copy.deepcopy(model))
+
+    image = _transform(model.visual.input_resolution)(Image.open("CLIP.png"))[None]
+    text = clip.tokenize(TEXTS, trim=True)
+    with torch.no_grad():
+        pairs = [
+            (model.encode_image(image), quantized.encode_image(image)),
+            (model.encode_text(text), quantized.encode_text(text)),
+            (model.encode_text(text, share_prefix=True), quantized.encode_text(text, share_prefix=True)),
+        ]
+
+    for expected, actual in pairs:
+        assert torch.nn.functional.cosine_similarity(actual, expected).min() > 0.99
+
+    block = quantized.transformer.resblocks[0]
+    assert block.attn.in_proj_weight is None
+    assert isinstance(block.mlp.c_fc, DynamicQuantizedLinear)
+    assert isinstance(block.in_proj_linear, DynamicQuantizedLinear)
+    assert isinstance(quantized.text_projection_linear, DynamicQuantizedLinear)
+    assert quantized.text_projection is None  # only the int8 copy is kept
+    if vision == "vit":
+        assert isinstance(quantized.visual.proj_linear, DynamicQuantizedLinear) and quantized.visual.proj is None
+
+
+def test_int8_needs_fp32_cpu_model():
+    with pytest.raises(ValueError):
+        quantize_int8(tiny_clip("vit").half())
+    with pytest.raises(ValueError):
+        clip.load("RN50", device="cpu", quantize="int4")
+    with pytest.raises(ValueError):
+        clip.load("RN50", device="cuda", quantize="int8")
@@ -0,0 +1,91 @@
+import threading
+
+import pytest
+import torch
+
+import clip
+from clip.registry import ModelRegistry, model_bytes
+from tests.conftest import tiny_clip
+
+
+@pytest.fixture
+def checkpoints(tmp_path):
+    paths = []
+    for seed in range(3):
+        path = str(tmp_path / f"tiny-{seed}.pt")
+        torch.save(tiny_clip("vit", seed=seed).state_dict(), path)
+        paths.append(path)
+    return paths
+
+
+def test_returns_shared_instances(checkpoints):
+    registry = ModelRegistry()
+    model, preprocess = registry.get(checkpoints[0], device="cpu")
+    assert registry.get(checkpoints[0], device="cpu", precision="fp32", towers="both")[0] is model
+    bf16 = registry.get(checkpoints[0], device="cpu", precision="bf16")[0]
+    assert bf16 is not model
+
+    info = registry.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 2, 2)
+    assert info.currbytes == model_bytes(model) + model_bytes(bf16) < 2 * model_bytes(model)
+
+    stats = registry.stats()[(checkpoints[0], "cpu", "fp32")]
+    assert (stats.loads, stats.hits, stats.resident) == (1, 1, True)
+    assert stats.load_seconds > 0 and stats.bytes == model_bytes(model)
+
+
+def test_evicts_least_recently_used_over_budget(checkpoints):
+    size = model_bytes(tiny_clip("vit"))
+    registry = ModelRegistry(memory_budget=int(2.5 * size))
+    first = registry.get(checkpoints[0], device="cpu")[0]
+    registry.get(checkpoints[1], device="cpu")
+    assert registry.get(checkpoints[0], device="cpu")[0] is first  # now checkpoints[1] is the least recently used
+
+    registry.get(checkpoints[2], device="cpu")
+    assert registry.cache_info().evictions == 1
+    assert {key[0]: stats.resident for key, stats in registry.stats().items()} == \
+           {checkpoints[0]: True, checkpoints[1]: False, checkpoints[2]: True}
+
+    registry.get(checkpoints[1], device="cpu")
+    assert registry.stats()[(checkpoints[1], "cpu", "fp32")].loads == 2
+    assert len(registry) == 2
+
+
+def test_model_over_budget_stays_resident(checkpoints):
+    registry = ModelRegistry(memory_budget=1)
+    with pytest.warns(UserWarning, match="over the registry's memory budget"):
+        model = registry.get(checkpoints[0], device="cpu")[0]
+    assert registry.get(checkpoints[0], device="cpu")[0] is model
+
+
+def test_unload_and_clear(checkpoints):
+    registry = ModelRegistry()
+    registry.get(checkpoints[0], device="cpu")
+    registry.get(checkpoints[1], device="cpu")
+    assert registry.unload(checkpoints[0], device="cpu")
+    assert not registry.unload(checkpoints[0], device="cpu")
+    registry.clear()
+    assert len(registry) == 0 and registry.cache_info().currbytes == 0
+
+
+def test_hits_do_not_wait_for_other_loads(checkpoints):
+    started, release = threading.Event(), threading.Event()
+
+    def loader(name, **kwargs):
+        if name == checkpoints[1]:
+            started.set()
+            assert release.wait(10)
+        return clip.load(name, **kwargs)
+
+    registry = ModelRegistry(loader=loader)
+    model = registry.get(checkpoints[0], device="cpu")[0]
+    thread = threading.Thread(target=registry.get, args=(checkpoints[1], "cpu"))
+    thread.start()
+    try:
+        assert started.wait(10)
+        assert registry.get(checkpoints[0], device="cpu")[0] is model  # would deadlock if the load held the lock
+    finally:
+        release.set()
+        thread.join()
+    assert registry.cache_info().currsize == 2
+
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+import pytest
+
+from benchmarks.reference import reference_bpe
+from clip.simple_tokenizer import SimpleTokenizer, compile_bpe, default_bpe
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return SimpleTokenizer()
+
+
+def test_bpe_matches_reference_over_vocab(tokenizer):
+    for symbol in tokenizer.encoder:
+        if symbol in ('<|startoftext|>', '<|endoftext|>'):
+            continue
+        token = symbol[:-len('</w>')] if symbol.endswith('</w>') else symbol
+        if not token:
+            continue
+        assert tokenizer.bpe(token) == reference_bpe(tokenizer, token), token
+
+
+@pytest.mark.parametrize('text', [
+    "a photo of a dog",
+    "https://www.example.com/some/very/long/path?query=value&other=thing",
+    "#throwbackthursday #supercalifragilisticexpialidocious aaaaaaaaaaaaaaaa",
+    "naïve café déjà vu — emoji 🐶🐱 and 中文字符",
+])
+def test_encode_matches_reference(tokenizer, text):
+    reference = SimpleTokenizer()
+    reference.bpe = lambda token: reference_bpe(reference, token)
+    assert tokenizer.encode(text) == reference.encode(text)
+    assert tokenizer.decode(tokenizer.encode(text)).strip() == reference.decode(reference.encode(text)).strip()
+
+
+def test_byte_table_matches_byte_encoder(tokenizer):
+    text = "naïve 🐶 中文 \x00\x7f"
+    expected = ''.join(tokenizer.byte_encoder[b] for b in text.encode('utf-8'))
+    assert text.encode('utf-8').decode('latin-1').translate(tokenizer.byte_table) == expected
+
+
+def test_cache_is_bounded_lru():
+    tokenizer = SimpleTokenizer(cache_size=2)
+    tokenizer.bpe("hello")
+    tokenizer.bpe("world")
+    tokenizer.bpe("hello")
+    tokenizer.bpe("again")
+
+    assert list(tokenizer.cache) == ["hello", "again"]
+    info = tokenizer.cache_info()
+    assert (info.hits, info.misses, info.evictions, info.currsize) == (1, 3, 1, 2)
+
+    tokenizer.clear_cache()
+    assert tokenizer.cache_info() == (0, 0, 0, 2, 0)
+
+
+def test_cache_tolerates_concurrent_eviction():
+    class EvictingCache(OrderedDict):
+        """Another thread evicts every token right after it is looked up"""
+        def get(self, key, default=None):
+            value = super().get(key, default)
+            self.pop(key, None)
+            return value
+
+    tokenizer = SimpleTokenizer(cache_size=1)
+    expected = tokenizer.bpe("hello")
+    tokenizer.cache = EvictingCache(tokenizer.cache)
+    assert tokenizer.bpe("hello") == expected
+    assert tokenizer.bpe("world") == SimpleTokenizer().bpe("world")
+
+
+def test_cache_disabled_keeps_special_tokens():
+    tokenizer = SimpleTokenizer(cache_size=0)
+    ids = tokenizer.encode("<|startoftext|>a photo of a dog<|endoftext|>")
+    assert ids[0] == tokenizer.encoder["<|startoftext|>"]
+    assert ids[-1] == tokenizer.encoder["<|endoftext|>"]
+    assert len(tokenizer.cache) == 0
+
+
+def test_warm_cache(tokenizer):
+    warm = SimpleTokenizer(warm_cache=1000)
+    assert 0 < len(warm.cache) <= 1000
+    assert warm.cache_info().misses == 0
+
+    warm.encode("the photo of the dog")
+    assert warm.cache_info().hits > 0
+    assert warm.encode("the photo of the dog") == tokenizer.encode("the photo of the dog")
+
+
+def test_compiled_bpe_is_drop_in(tokenizer, tmp_path):
+    compiled_path = str(tmp_path / "bpe_simple_vocab_16e6.bin")
+    compile_bpe(default_bpe(), compiled_path)
+    compiled = SimpleTokenizer(compiled_path)
+
+    assert compiled.encoder == tokenizer.encoder
+    assert compiled.decoder == tokenizer.decoder
+    assert compiled.bpe_ranks == tokenizer.bpe_ranks
+    text = "a compiled vocabulary loads the same merges 🐶"
+    assert compiled.encode(text) == tokenizer.encode(text)
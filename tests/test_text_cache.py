@@ -0,0 +1,86 @@
+import copy
+
+import torch
+
+import clip
+
+PROMPTS = ["a photo of a dog", "a photo of a cat", "a photo of a dog", "a diagram"]
+
+
+def test_cache_matches_encode_text_and_dedups(vit_model):
+    cache = clip.TextFeatureCache(vit_model, capacity=8)
+    text = clip.tokenize(PROMPTS)
+    with torch.no_grad():
+        expected = vit_model.encode_text(text)
+
+    assert torch.allclose(cache(text), expected, atol=1e-5)
+    assert cache.cache_info().misses == 3
+
+    assert torch.allclose(cache(clip.tokenize(PROMPTS, trim=True)), expected, atol=1e-5)
+    info = cache.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (3, 3, 3)
+    assert cache.hit_rate() == 0.5
+
+
+def test_cache_evicts_least_recently_used(vit_model):
+    cache = clip.TextFeatureCache(vit_model, capacity=2)
+    cache.encode(["a dog", "a cat"])
+    cache.encode(["a dog"])
+    cache.encode(["a bird"])
+
+    assert cache.cache_info().evictions == 1
+    assert len(cache.memory) == 2
+    cache.encode(["a cat"])
+    assert cache.cache_info().misses == 4
+
+
+def test_disk_tier_survives_restart(vit_model, tmp_path):
+    first = clip.TextFeatureCache(vit_model, path=str(tmp_path))
+    expected = first.encode(PROMPTS)
+
+    second = clip.TextFeatureCache(vit_model, path=str(tmp_path))
+    features = second.encode(PROMPTS)
+    info = second.cache_info()
+    assert (info.hits, info.disk_hits, info.misses) == (0, 3, 0)
+    assert torch.allclose(features, expected, atol=1e-2)
+
+    other_model = copy.deepcopy(vit_model)
+    other_model.text_projection.data.mul_(2)
+    other = clip.TextFeatureCache(other_model, path=str(tmp_path))
+    other.encode(PROMPTS)
+    assert other.cache_info().disk_hits == 0
+
+
+def test_disk_tier_separates_models_with_different_text_blocks(vit_model, tmp_path):
+    clip.TextFeatureCache(vit_model, path=str(tmp_path)).encode(PROMPTS)
+
+    finetuned = copy.deepcopy(vit_model)
+    finetuned.transformer.resblocks[-1].mlp.c_proj.weight.data.add_(0.01)
+    cache = clip.TextFeatureCache(finetuned, path=str(tmp_path))
+    features = cache.encode(PROMPTS)
+    assert cache.cache_info().disk_hits == 0
+    with torch.no_grad():
+        assert torch.allclose(features, finetuned.encode_text(clip.tokenize(PROMPTS)), atol=1e-5)
+
+
+def test_disk_tier_recovers_from_interrupted_writes(vit_model, tmp_path):
+    first = clip.TextFeatureCache(vit_model, path=str(tmp_path))
+    expected = first.encode(PROMPTS)
+    root = tmp_path / first.model_key
+
+    # rows written without their index entries, a duplicated entry, a truncated row and a truncated index line
+    with open(root / "features.f16", "ab") as f:
+        f.write(torch.ones(2, expected.shape[1], dtype=torch.float16).numpy().tobytes() + b"\0" * 7)
+    with open(root / "index.txt", "a") as f:
+        index = (root / "index.txt").read_text().splitlines()
+        f.write(index[0] + "\n" + "deadbeef")
+
+    second = clip.TextFeatureCache(vit_model, path=str(tmp_path))
+    assert second.disk.rows == 5
+    features = second.encode(PROMPTS + ["a new prompt"])
+    assert second.cache_info().disk_hits == 3
+    assert torch.allclose(features[:4], expected, atol=1e-2)
+
+    third = clip.TextFeatureCache(vit_model, path=str(tmp_path))
+    assert torch.allclose(third.encode(["a new prompt"]), features[4:], atol=1e-2)
+    assert third.cache_info().disk_hits == 1
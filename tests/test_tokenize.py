@@ -0,0 +1,32 @@
+import pytest
+import torch
+
+import clip
+
+CAPTIONS = [f"a photo of {i} dogs and a cat #caption{i}" for i in range(50)]
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_tokenize_batch_matches_tokenize(num_workers):
+    expected = clip.tokenize(CAPTIONS)
+    assert torch.equal(clip.tokenize_batch(CAPTIONS, chunk_size=8, num_workers=num_workers), expected)
+    assert torch.equal(clip.tokenize_batch(iter(CAPTIONS), chunk_size=8, num_workers=num_workers), expected)
+
+
+def test_tokenize_iter_yields_ordered_chunks():
+    chunks = list(clip.tokenize_iter((c for c in CAPTIONS), chunk_size=16, num_workers=2))
+    assert [len(chunk) for chunk in chunks] == [16, 16, 16, 2]
+    assert all(chunk.dtype == torch.long and chunk.shape[1] == 77 for chunk in chunks)
+    assert torch.equal(torch.cat(chunks), clip.tokenize(CAPTIONS))
+
+
+def test_tokenize_batch_truncation():
+    long_text = "dog " * 100
+    with pytest.raises(RuntimeError):
+        clip.tokenize_batch([long_text], num_workers=2)
+    assert torch.equal(clip.tokenize_batch([long_text], truncate=True, num_workers=0), clip.tokenize(long_text, truncate=True))
+
+
+def test_tokenize_batch_accepts_a_single_string():
+    assert torch.equal(clip.tokenize_batch("a photo", num_workers=0), clip.tokenize("a photo"))
+    assert torch.equal(next(clip.tokenize_iter("a photo", num_workers=0)), clip.tokenize("a photo"))
@@ -0,0 +1,176 @@
+import pytest
+import torch
+
+from tests.conftest import tiny_clip
+
+
+def test_resnet_runs_on_cpu_without_printing(resnet_model, capsys):
+    images = torch.randn(2, 3, 64, 64)
+    with torch.no_grad():
+        resnet_model.encode_image(images)
+    assert capsys.readouterr().out == ""
+
+
+def test_resnet_debug_hook(resnet_model):
+    stages = []
+    resnet_model.visual.debug_hook = lambda name, x: stages.append((name, tuple(x.shape)))
+    try:
+        with torch.no_grad():
+            resnet_model.encode_image(torch.randn(2, 3, 64, 64))
+    finally:
+        resnet_model.visual.debug_hook = None
+
+    assert [name for name, _ in stages] == ["stem", "layer1", "layer2", "layer3", "layer4", "attnpool"]
+    assert stages[4][1] == (2, 16 * 32, 2, 2)
+
+
+def test_encode_image_dense(resnet_model, vit_model):
+    for model, resolution, grid in [(resnet_model, 64, (2, 2)), (vit_model, 32, (4, 4))]:
+        images = torch.randn(2, 3, resolution, resolution)
+        with torch.no_grad():
+            pooled = model.encode_image(images)
+            dense_pooled, dense = model.encode_image_dense(images)
+
+        assert pooled.shape == (2, model.text_projection.shape[1])
+        assert dense.shape == (2, *grid, model.text_projection.shape[1])
+        assert torch.allclose(dense_pooled, pooled, atol=1e-5)
+
+
+def test_attnpool_pooled_only_matches_full_attention(resnet_model):
+    attnpool = resnet_model.visual.attnpool
+    features = torch.randn(2, attnpool.k_proj.in_features, 5, 7)
+    with torch.no_grad():
+        full = attnpool(features)
+        pooled = attnpool(features, pooled_only=True)
+
+    assert full.shape[0] == 5 * 7 + 1
+    assert pooled.shape == (1, *full.shape[1:])
+    assert torch.allclose(pooled[0], full[0], atol=1e-5)
+
+
+def test_resample_positional_embedding():
+    from collections import OrderedDict
+
+    from clip.model import resample_positional_embedding
+
+    # an embedding that only varies along the grid rows must still only vary along the rows after resampling
+    rows = torch.arange(4.0)[:, None, None].expand(4, 4, 8).reshape(16, 8)
+    positional_embedding = torch.cat([torch.full((1, 8), -1.0), rows])
+    resampled = resample_positional_embedding(positional_embedding, (6, 10), torch.float32)
+    assert resampled.shape == (61, 8)
+    assert torch.equal(resampled[0], positional_embedding[0])
+    grid = resampled[1:].reshape(6, 10, 8)
+    assert torch.allclose(grid, grid[:, :1], atol=1e-6)
+    assert torch.all(grid[1:, 0] >= grid[:-1, 0])
+
+    assert resample_positional_embedding(positional_embedding, (4, 4), torch.float32) is positional_embedding
+
+    cache = OrderedDict()
+    first = resample_positional_embedding(positional_embedding, (6, 10), torch.float32, cache, max_cache_entries=2)
+    assert resample_positional_embedding(positional_embedding, (6, 10), torch.float32, cache, max_cache_entries=2) is first
+    resample_positional_embedding(positional_embedding, (5, 5), torch.float32, cache, max_cache_entries=2)
+    resample_positional_embedding(positional_embedding, (7, 7), torch.float32, cache, max_cache_entries=2)
+    assert [key[0] for key in cache] == [(5, 5), (7, 7)]
+
+    # in-place updates, such as load_state_dict, must not be served stale entries
+    stale = resample_positional_embedding(positional_embedding, (7, 7), torch.float32, cache)
+    positional_embedding.add_(1)
+    fresh = resample_positional_embedding(positional_embedding, (7, 7), torch.float32, cache)
+    assert torch.allclose(fresh, stale + 1, atol=1e-5)
+
+
+def test_towers_accept_arbitrary_resolutions(resnet_model, vit_model):
+    towers = [
+        (resnet_model, resnet_model.visual.attnpool, (96, 160), (3, 5)),
+        (vit_model, vit_model.visual, (24, 48), (3, 6)),
+    ]
+    for model, module, size, grid in towers:
+        module._positional_embedding_cache.clear()
+        with torch.no_grad():
+            pooled, dense = model.encode_image_dense(torch.randn(2, 3, *size))
+            assert model.encode_image(torch.randn(2, 3, *size)).shape == pooled.shape
+        assert dense.shape[1:3] == grid
+        assert len(module._positional_embedding_cache) == 1
+
+
+def test_merge_tokens_merges_duplicates_and_keeps_class_token():
+    from clip.model import merge_tokens
+
+    torch.manual_seed(0)
+    cls, first, second = torch.randn(3, 1, 1, 8)
+    x = torch.cat([cls, first, first, second, second], dim=1)
+    size = torch.ones(1, 5, 1)
+    merged, merged_size = merge_tokens(x, size, x, r=2)
+
+    assert torch.equal(merged[:, 0], cls[:, 0])
+    assert merged_size.flatten().tolist() == [1, 2, 2]
+    assert torch.allclose(merged[0, 1:], torch.cat([first, second], dim=1)[0], atol=1e-6)
+
+
+def test_proportional_attention_matches_duplicated_tokens(vit_model):
+    block = vit_model.visual.transformer.resblocks[0]
+    torch.manual_seed(0)
+    cls, first, second = torch.randn(3, 1, 2, 64)
+    with torch.no_grad():
+        full = block(torch.cat([cls, first, first, second, second]))
+        merged, size = block.forward_merging(torch.cat([cls, first, second]), torch.tensor([1.0, 2.0, 2.0]).expand(2, 3)[..., None], r=0)
+
+    assert size.shape == (2, 3, 1)
+    assert torch.allclose(merged, full[[0, 1, 3]], atol=1e-5)
+
+
+def test_token_merging(vit_model, monkeypatch):
+    lengths = []
+    for block in vit_model.visual.transformer.resblocks:
+        def forward_merging(x, size, r, block=block, forward_merging=block.forward_merging):
+            lengths.append(len(x))
+            return forward_merging(x, size, r)
+        monkeypatch.setattr(block, "forward_merging", forward_merging)
+
+    images = torch.randn(2, 3, 64, 64)  # an 8x8 patch grid
+    with torch.no_grad():
+        baseline = vit_model.encode_image(images)
+        _, dense = vit_model.encode_image_dense(images)
+        assert lengths == []
+
+        monkeypatch.setattr(vit_model.visual, "token_merging", 0.25)
+        merged = vit_model.encode_image(images)
+        assert lengths == [65, 49]
+        monkeypatch.setattr(vit_model.visual, "token_merging", [0.5, 0.0])
+        vit_model.encode_image(images)
+        assert lengths[2:] == [65, 33]
+        assert torch.equal(vit_model.encode_image_dense(images)[1], dense)
+
+    assert merged.shape == baseline.shape
+    assert torch.nn.functional.cosine_similarity(merged, baseline).min() > 0.9
+
+
+@pytest.mark.parametrize("ratios", [[0.1], [0.1, 0.0, 0.0]])
+def test_token_merging_needs_a_ratio_per_block(vit_model, monkeypatch, ratios):
+    monkeypatch.setattr(vit_model.visual, "token_merging", ratios)
+    with pytest.raises(ValueError, match="2 blocks"):
+        vit_model.encode_image(torch.randn(1, 3, 64, 64))
+
+
+@pytest.mark.parametrize("channels_last", [False, True])
+def test_fuse_for_inference(channels_last):
+    model = tiny_clip("resnet")
+    torch.manual_seed(0)
+    for module in model.visual.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):  # non-trivial statistics, as in a trained checkpoint
+            module.running_mean.normal_()
+            module.running_var.uniform_(0.5, 2.0)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.normal_()
+
+    images = torch.randn(2, 3, 64, 96)
+    with torch.no_grad():
+        expected = model.encode_image_dense(images)
+        model.visual.fuse_for_inference(channels_last=channels_last)
+        actual = model.encode_image_dense(images)
+
+    assert not any(isinstance(module, torch.nn.BatchNorm2d) for module in model.visual.modules())
+    assert getattr(model.visual.layer1[0].downsample, "0").bias is not None
+    assert model.visual.conv1.weight.is_contiguous(memory_format=torch.channels_last) == channels_last
+    for a, e in zip(actual, expected):
+        assert torch.allclose(a, e, rtol=1e-4, atol=1e-4)
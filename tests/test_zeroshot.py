@@ -0,0 +1,40 @@
+import torch
+
+import clip
+
+CLASSES = ["dog", "cat", "golden retriever", "hot air balloon", "jellyfish", "espresso", "airplane"]
+TEMPLATES = ["a photo of a {}.", "a blurry photo of the {}.", "{} in the wild."]
+
+
+def test_build_zeroshot_head_matches_manual_ensemble(vit_model):
+    weights = clip.build_zeroshot_head(vit_model, CLASSES, TEMPLATES, batch_size=3)
+
+    with torch.no_grad():
+        expected = []
+        for c in CLASSES:
+            features = vit_model.encode_text(clip.tokenize([t.format(c) for t in TEMPLATES]))
+            features = features / features.norm(dim=-1, keepdim=True)
+            expected.append(features.mean(dim=0))
+        expected = torch.stack(expected)
+        expected = expected / expected.norm(dim=-1, keepdim=True)
+
+    assert weights.shape == (len(CLASSES), vit_model.text_projection.shape[1])
+    assert torch.allclose(weights, expected, atol=1e-5)
+
+
+def test_classify_streams_topk(vit_model, tmp_path):
+    weights = clip.build_zeroshot_head(vit_model, CLASSES, TEMPLATES)
+    clip.save_zeroshot_head(str(tmp_path / "head.pt"), weights, CLASSES)
+    weights, classnames = clip.load_zeroshot_head(str(tmp_path / "head.pt"))
+    assert classnames == CLASSES
+
+    images = torch.randn(4, 3, 32, 32)
+    probs, indices = clip.classify(vit_model, images, weights, topk=3, chunk_size=2)
+
+    with torch.no_grad():
+        image_features = vit_model.encode_image(images)
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        expected_probs, expected_indices = (vit_model.logit_scale.exp() * image_features @ weights.t()).softmax(dim=-1).topk(3)
+
+    assert torch.equal(indices, expected_indices)
+    assert torch.allclose(probs, expected_probs, atol=1e-5)